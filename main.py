@@ -1,13 +1,35 @@
+import time
+IMPORT_STARTED = time.perf_counter()
+
 import os
+import sys
+import io
+import csv
 import json
-import time
-from datetime import datetime, timedelta
-from flask import Flask, render_template, request, jsonify
-import gspread
-from google.oauth2.service_account import Credentials
+import random
+import bisect
+import hashlib
+import hmac
+import functools
+import sqlite3
+import struct
+import tempfile
+import threading
+import subprocess
+from array import array
+from collections import deque
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from itertools import islice
+from flask import Flask, Response, g, has_request_context, render_template, request, jsonify
 from dotenv import load_dotenv
 import traceback
 
+try:
+    import fcntl
+except ImportError:  # Windows (dev local) không có fcntl
+    fcntl = None
+
 # Load environment variables
 load_dotenv()
 
@@ -17,12 +39,14 @@ APP_VERSION = "1.0.2"
 # ==================== CACHE SYSTEM ====================
 data_cache = {}
 cache_timestamp = {}
+last_good_data = {}  # Bản tốt gần nhất, chỉ dùng khi Google Sheets lỗi
 last_request_time = {}
 REQUEST_INTERVAL = 2  # 2 giây giữa các request
 CACHE_MAX_AGE = 30  # 30 giây
 
 def rate_limit(api_name):
-    """Giới hạn tần suất request"""
+    """Giới hạn tần suất request (riêng cho từng tenant)"""
+    api_name = tenant_key(api_name)
     current_time = time.time()
     
     if api_name in last_request_time:
@@ -50,48 +74,348 @@ def clear_old_cache():
             del cache_timestamp[sheet_name]
         print(f"🧹 [AUTO_CLEAR] Đã xóa cache {sheet_name}")
 
-def get_cached_data(sheet_name, cache_duration=10):  # Giảm cache time xuống 10 giây
-    """Lấy dữ liệu có cache để giảm request"""
+# ==================== SHARED SNAPSHOT (GIỮA CÁC WORKER) ====================
+# Mỗi worker gunicorn có data_cache riêng. Để không nhân số request Google Sheets
+# theo số worker, chỉ một worker (giữ khóa file) lấy dữ liệu mới và ghi ra file
+# snapshot dạng cột; các worker khác đọc file đó thay vì gọi Google Sheets.
+# Chỉ lượt gọi upstream được chia sẻ, không phải bộ nhớ: mỗi worker parse snapshot
+# thành record + DateIndex của riêng nó, nên RAM vẫn tăng theo số worker.
+SNAPSHOT_ENABLED = os.environ.get('SHARED_CACHE', '1') != '0'
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'phonghocnhom_cache'))
+SNAPSHOT_MAGIC = b'PHNS'
+SNAPSHOT_VERSION = 1
+# magic, version, số cột, generation, thời điểm lấy dữ liệu, số dòng
+SNAPSHOT_HEADER = struct.Struct('<4sHHQdI')
+SNAPSHOT_U32 = struct.Struct('<I')
+snapshot_generation = {}
+# Sau khi ghi dữ liệu, worker ghi thời điểm vô hiệu vào file .invalidated cạnh
+# snapshot; snapshot lấy dữ liệu trước thời điểm đó (một worker khác đang làm mới
+# song song) bị bỏ qua để lần đọc tiếp theo luôn thấy dòng vừa ghi.
+
+def _snapshot_path(sheet_name, suffix='.snap'):
+    """Tên file gồm spreadsheet id để các deployment khác SHEET_ID trên cùng máy
+    (cùng thư mục tạm) không đọc nhầm snapshot của nhau"""
+    tenant_id, name = split_tenant_key(sheet_name)
+    safe_name = ''.join(c if c.isalnum() else '_' for c in f"{tenants[tenant_id].sheet_id}-{name}")
+    return os.path.join(SNAPSHOT_DIR, safe_name + suffix)
+
+def write_snapshot(sheet_name, rows, fetched_at):
+    """Ghi snapshot dạng cột ra file rồi thay thế nguyên tử (os.replace)
+
+    Bố cục: header | độ dài từng dòng (u32) | với mỗi cột: offset ký tự (u32,
+    n_rows + 1 phần tử), độ dài blob (u32), blob UTF-8 của cả cột.
+    """
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    n_rows = len(rows)
+    n_cols = max((len(row) for row in rows), default=0)
+    generation = time.time_ns()
+
+    fd, tmp_path = tempfile.mkstemp(dir=SNAPSHOT_DIR, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, n_cols,
+                                         generation, fetched_at, n_rows))
+            f.write(array('I', (len(row) for row in rows)).tobytes())
+
+            for col_idx in range(n_cols):
+                offsets = array('I', [0])
+                cells = []
+                position = 0
+                for row in rows:
+                    cell = str(row[col_idx]) if col_idx < len(row) else ''
+                    cells.append(cell)
+                    position += len(cell)
+                    offsets.append(position)
+
+                blob = ''.join(cells).encode('utf-8')
+                f.write(offsets.tobytes())
+                f.write(SNAPSHOT_U32.pack(len(blob)))
+                f.write(blob)
+
+        os.replace(tmp_path, _snapshot_path(sheet_name))
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return generation
+
+def _read_snapshot_rows(body, n_cols, n_rows):
+    """Giải mã phần thân snapshot (bytes sau header) thành list các dòng"""
+    position = 0
+    row_lengths = array('I')
+    row_lengths.frombytes(body[position:position + 4 * n_rows])
+    position += 4 * n_rows
+
+    if n_cols == 0:
+        return [[] for _ in range(n_rows)]
+
+    columns = []
+    for _ in range(n_cols):
+        offsets = array('I')
+        offsets.frombytes(body[position:position + 4 * (n_rows + 1)])
+        position += 4 * (n_rows + 1)
+
+        (blob_len,) = SNAPSHOT_U32.unpack_from(body, position)
+        position += SNAPSHOT_U32.size
+        text = str(body[position:position + blob_len], 'utf-8')
+        position += blob_len
+
+        columns.append([text[offsets[i]:offsets[i + 1]] for i in range(n_rows)])
+
+    return [list(cells[:length]) for cells, length in zip(zip(*columns), row_lengths)]
+
+def read_invalidated_at(sheet_name):
+    try:
+        with open(_snapshot_path(sheet_name, '.invalidated')) as f:
+            return float(f.read() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0.0
+
+def write_invalidated_at(sheet_name, invalidated_at):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=SNAPSHOT_DIR, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(repr(invalidated_at))
+        os.replace(tmp_path, _snapshot_path(sheet_name, '.invalidated'))
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def load_snapshot(sheet_name, max_age, allow_invalidated=False):
+    """Nạp snapshot của worker khác nếu còn mới, trả về None nếu không dùng được
+
+    allow_invalidated: vẫn dùng snapshot lấy trước lần ghi gần nhất (khi phục vụ
+    dữ liệu cũ lúc Google Sheets lỗi).
+    """
+    if not SNAPSHOT_ENABLED:
+        return None
+
+    try:
+        f = open(_snapshot_path(sheet_name), 'rb')
+    except FileNotFoundError:
+        return None
+
+    # Đọc header trước; phần thân chỉ đọc khi thật sự cần giải mã
+    with f:
+        header = f.read(SNAPSHOT_HEADER.size)
+        if len(header) < SNAPSHOT_HEADER.size:
+            return None
+
+        magic, version, n_cols, generation, fetched_at, n_rows = SNAPSHOT_HEADER.unpack(header)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            return None
+        if time.time() - fetched_at >= max_age:
+            return None
+        if not allow_invalidated and fetched_at < read_invalidated_at(sheet_name):
+            return None
+
+        # Cùng generation đã nạp trước đó -> không cần giải mã lại
+        if snapshot_generation.get(sheet_name) == generation and sheet_name in data_cache:
+            cache_timestamp[sheet_name] = fetched_at
+            return data_cache[sheet_name]
+
+        data = _read_snapshot_rows(f.read(), n_cols, n_rows)
+
+    data = store_in_cache(sheet_name, data, fetched_at)
+    snapshot_generation[sheet_name] = generation
+    print(f"📂 [SNAPSHOT] Nạp snapshot {sheet_name} (generation {generation}, {n_rows} dòng)")
+    return data
+
+def publish_snapshot(sheet_name, data, fetched_at):
+    """Ghi snapshot cho các worker khác, lỗi ghi file không làm hỏng request"""
+    if not SNAPSHOT_ENABLED:
+        return
+
+    try:
+        snapshot_generation[sheet_name] = write_snapshot(sheet_name, data, fetched_at)
+    except OSError as e:
+        print(f"⚠️ [SNAPSHOT] Không ghi được snapshot {sheet_name}: {e}")
+
+def remove_snapshot(sheet_name):
+    """Vô hiệu snapshot sau khi dữ liệu trên sheet thay đổi"""
+    snapshot_generation.pop(sheet_name, None)
+    if not SNAPSHOT_ENABLED:
+        return
+
+    try:
+        write_invalidated_at(sheet_name, time.time())
+        os.remove(_snapshot_path(sheet_name))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"⚠️ [SNAPSHOT] Không xóa được snapshot {sheet_name}: {e}")
+
+@contextmanager
+def snapshot_refresh_lock(sheet_name):
+    """Khóa file để chỉ một worker làm mới một sheet tại một thời điểm"""
+    if not SNAPSHOT_ENABLED or fcntl is None:
+        yield
+        return
+
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        lock_file = open(_snapshot_path(sheet_name, '.lock'), 'a')
+    except OSError as e:
+        print(f"⚠️ [SNAPSHOT] Không tạo được khóa {sheet_name}: {e}")
+        yield
+        return
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+def get_cached_data(sheet_name, cache_duration=10, cell_range=None):  # Giảm cache time xuống 10 giây
+    """Lấy dữ liệu có cache để giảm request
+
+    cell_range (vd. 'A1:D21') chỉ đọc một vùng của sheet, vùng này được cache riêng.
+    Khóa cache và snapshot có tiền tố tenant (xem tenant_key).
+    """
+    cache_key = tenant_key(f"{sheet_name}!{cell_range}" if cell_range else sheet_name)
+    
     # Xóa cache cũ trước
     clear_old_cache()
     
     current_time = time.time()
     
     # Kiểm tra cache
-    if (sheet_name in data_cache and 
-        sheet_name in cache_timestamp and
-        current_time - cache_timestamp[sheet_name] < cache_duration):
-        print(f"📦 [CACHE] Sử dụng cache cho {sheet_name}")
-        return data_cache[sheet_name]
+    if (cache_key in data_cache and 
+        cache_key in cache_timestamp and
+        current_time - cache_timestamp[cache_key] < cache_duration):
+        print(f"📦 [CACHE] Sử dụng cache cho {cache_key}")
+        return data_cache[cache_key]
+    
+    # Worker khác có thể đã lấy dữ liệu mới
+    data = load_snapshot(cache_key, cache_duration)
+    if data is not None:
+        return data
     
     # Lấy dữ liệu mới
-    print(f"🔄 [CACHE] Lấy dữ liệu mới cho {sheet_name}")
+    print(f"🔄 [CACHE] Lấy dữ liệu mới cho {cache_key}")
     try:
-        client = connect_to_sheets()
-        if not client:
-            return []
+        with snapshot_refresh_lock(cache_key):
+            # Trong lúc chờ khóa, worker giữ khóa có thể đã ghi snapshot mới
+            data = load_snapshot(cache_key, cache_duration)
+            if data is not None:
+                return data
             
-        sheet_id = os.environ.get('SHEET_ID', '1i5N5Gdk-SqPN7Vy5IFiHiK5CTCw9WDag2EMZ1GBI8Wo')
-        spreadsheet = client.open_by_key(sheet_id)
-        sheet = spreadsheet.worksheet(sheet_name)
-        
-        data = sheet.get_all_values()
-        
-        # Lưu cache
-        data_cache[sheet_name] = data
-        cache_timestamp[sheet_name] = current_time
-        
-        return data
+            current_time = time.time()
+            if cell_range:
+                data = fetch_range(sheet_name, cell_range)
+            else:
+                sheet = get_worksheet(sheet_name)
+                data = sheets_call(sheet.get_all_values) if sheet else None
+            
+            if data is None:
+                return empty_sheet_data(cache_key)
+            
+            # Lưu cache
+            publish_snapshot(cache_key, data, current_time)
+            return store_in_cache(cache_key, data, current_time)
         
+    except UpstreamUnavailable as e:
+        print(f"⛔ [CIRCUIT] {e}, dùng dữ liệu cũ cho {cache_key}")
+        return serve_stale(cache_key)
     except Exception as e:
-        print(f"❌ [CACHE] Lỗi lấy dữ liệu {sheet_name}: {e}")
-        return []
+        print(f"❌ [CACHE] Lỗi lấy dữ liệu {cache_key}: {e}")
+        return serve_stale(cache_key)
+
+# ==================== RANGE READS ====================
+# Đọc một vùng (cột + cửa sổ dòng) bằng values_get thay vì get_all_values cả sheet:
+# một request, ít dữ liệu truyền về và không cần đọc metadata worksheet.
+def column_letter(index):
+    """0 -> 'A', 25 -> 'Z', 26 -> 'AA'"""
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+def fetch_range(sheet_name, cell_range):
+    """Đọc một vùng A1 của sheet, các dòng được đệm cho đều số cột như get_all_values"""
+    spreadsheet = open_spreadsheet()
+    if not spreadsheet:
+        return None
+    
+    quoted_name = sheet_name.replace("'", "''")
+    response = sheets_call(spreadsheet.values_get, f"'{quoted_name}'!{cell_range}")
+    rows = response.get('values', [])
+    width = max((len(row) for row in rows), default=0)
+    return [row + [''] * (width - len(row)) for row in rows]
+
+def projection_range(columns, first_row, last_row):
+    first_col, last_col = min(columns), max(columns)
+    return f"{column_letter(first_col)}{first_row}:{column_letter(last_col)}{last_row or ''}"
+
+def project_rows(rows, columns):
+    offsets = [col - min(columns) for col in columns]
+    return [[row[i] if i < len(row) else '' for i in offsets] for row in rows]
+
+def get_projection(sheet_name, columns, first_row=1, last_row=None, cache_duration=10):
+    """Các cột `columns` (đánh số từ 0) trong dòng first_row..last_row (đánh số từ 1), có cache"""
+    rows = get_cached_data(sheet_name, cache_duration, projection_range(columns, first_row, last_row))
+    return project_rows(rows, columns)
+
+def fetch_projection(sheet_name, columns, first_row=1, last_row=None):
+    """Như get_projection nhưng không cache và báo lỗi thay vì trả về dữ liệu cũ"""
+    rows = fetch_range(sheet_name, projection_range(columns, first_row, last_row))
+    if rows is None:
+        raise RuntimeError('Không thể kết nối Google Sheets')
+    return project_rows(rows, columns)
+
+def store_in_cache(sheet_name, rows, fetched_at):
+    """Lưu dữ liệu vào cache, parse thành record một lần nếu sheet có parser"""
+    parser = SHEET_PARSERS.get(split_tenant_key(sheet_name)[1])
+    data = parser(rows) if parser else rows
+    if parser:
+        data.fetched_at = fetched_at
+    data_cache[sheet_name] = data
+    cache_timestamp[sheet_name] = fetched_at
+    last_good_data[sheet_name] = (data, fetched_at)
+    return data
+
+def serve_stale(sheet_name):
+    """Trả về bản tốt gần nhất (đánh dấu stale) khi không lấy được dữ liệu mới"""
+    if sheet_name in last_good_data:
+        data, fetched_at = last_good_data[sheet_name]
+    else:
+        # Worker mới khởi động: dùng snapshot của worker khác dù đã cũ
+        data = load_snapshot(sheet_name, float('inf'), allow_invalidated=True)
+        if data is None:
+            return empty_sheet_data(sheet_name)
+        fetched_at = cache_timestamp[sheet_name]
+    
+    if has_request_context():
+        stale_sheets = g.setdefault('stale_sheets', {})
+        stale_sheets[sheet_name] = fetched_at
+    return data
+
+def empty_sheet_data(sheet_name):
+    parser = SHEET_PARSERS.get(split_tenant_key(sheet_name)[1])
+    return parser([]) if parser else []
+
+def invalidate_cache(sheet_name):
+    """Xóa cache một sheet của tenant hiện tại ở worker này và snapshot dùng chung"""
+    cache_key = tenant_key(sheet_name)
+    data_cache.pop(cache_key, None)
+    cache_timestamp.pop(cache_key, None)
+    remove_snapshot(cache_key)
 
 def clear_cache():
-    """Xóa cache (có thể gọi từ API nếu cần)"""
-    data_cache.clear()
-    cache_timestamp.clear()
-    print("🧹 [CACHE] Đã xóa toàn bộ cache")
+    """Xóa cache của tenant hiện tại (có thể gọi từ API nếu cần)"""
+    tenant_id = current_tenant().id
+    for cache_key in set(data_cache) | set(snapshot_generation):
+        if split_tenant_key(cache_key)[0] == tenant_id:
+            remove_snapshot(cache_key)
+            data_cache.pop(cache_key, None)
+            cache_timestamp.pop(cache_key, None)
+    print(f"🧹 [CACHE] Đã xóa toàn bộ cache (tenant {tenant_id})")
 
 # ==================== CACHE HEADERS ====================
 @app.after_request
@@ -101,10 +425,261 @@ def add_header(response):
         response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
         response.headers['Pragma'] = 'no-cache'
         response.headers['Expires'] = '0'
+    
+    # Dữ liệu trả về là bản cũ do Google Sheets đang lỗi / circuit đang mở
+    stale_sheets = g.get('stale_sheets')
+    if stale_sheets:
+        response.headers['X-Data-Stale'] = ','.join(sorted(split_tenant_key(key)[1] for key in stale_sheets))
+        response.headers['X-Data-Age'] = str(int(time.time() - min(stale_sheets.values())))
     return response
 
+# ==================== PROFILING ====================
+# Profile theo yêu cầu cho route chậm: bật bằng header X-Profile (kèm X-Admin-Token)
+# cho một request, hoặc bật cho N request tiếp theo của một route qua /api/profiling.
+# Khi không bật, mỗi request chỉ tốn một phép kiểm tra; cProfile chỉ được import khi cần.
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_HISTORY = 20
+PROFILE_TOP_FUNCTIONS = 20
+PROFILE_MAX_REQUESTS = 100
+
+# Thời gian của mỗi nhóm tính từ các hàm đầu vào (cumulative, không tính lồng nhau)
+PROFILE_CATEGORIES = {
+    'normalize_date': ('normalize_date',),
+    'jsonify': ('jsonify',),
+}
+# Thời gian nằm trong thư viện gọi Google API (kể cả I/O socket do chúng gọi),
+# xác định theo thư mục package của file nguồn
+PROFILE_UPSTREAM_PACKAGES = ('gspread', 'google', 'requests', 'urllib3')
+# Thời gian time.sleep theo hàm gọi trong main.py: chờ quota và backoff khi retry
+PROFILE_WAITS = {
+    'quota_wait': 'acquire',
+    'backoff_wait': 'sheets_call',
+}
+
+profile_targets = {}  # path -> số request còn lại cần profile
+recent_profiles = deque(maxlen=PROFILE_HISTORY)
+profile_lock = threading.Lock()
+profile_counter = [0]
+
+def is_admin_request():
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(token, PROFILE_TOKEN)
+
+def should_profile():
+    if request.headers.get('X-Profile') and is_admin_request():
+        return True
+    
+    with profile_lock:
+        remaining = profile_targets.get(request.path)
+        if not remaining:
+            return False
+        if remaining <= 1:
+            del profile_targets[request.path]
+        else:
+            profile_targets[request.path] = remaining - 1
+    return True
+
+def category_time(stats, in_group):
+    """Cumulative time của các hàm thuộc nhóm, bỏ qua lời gọi từ một hàm cùng nhóm"""
+    total = 0.0
+    for func, (_cc, _nc, _tt, ct, callers) in stats.items():
+        if not in_group(func):
+            continue
+        if not callers:
+            total += ct
+            continue
+        for caller, caller_stats in callers.items():
+            if not in_group(caller):
+                total += caller_stats[3]
+    return total
+
+def in_upstream_package(func):
+    path = func[0].replace('\\', '/')
+    return any(f"/{package}/" in path for package in PROFILE_UPSTREAM_PACKAGES)
+
+def sleep_time(stats, caller_name):
+    """Tổng thời gian time.sleep được gọi trực tiếp từ hàm caller_name của main.py"""
+    callers = stats.get(('~', 0, '<built-in method time.sleep>'), (0, 0, 0, 0, {}))[4]
+    total = 0.0
+    for caller, caller_stats in callers.items():
+        if caller[0] == __file__ and caller[2] == caller_name:
+            total += caller_stats[3]
+    return total
+
+def summarize_profile(profiler, wall_time):
+    import pstats
+    
+    stats = pstats.Stats(profiler).stats
+    categories = {'gspread': round(category_time(stats, in_upstream_package) * 1000, 2)}
+    for name, names in PROFILE_CATEGORIES.items():
+        categories[name] = round(category_time(stats, lambda func: func[2] in names) * 1000, 2)
+    for name, caller_name in PROFILE_WAITS.items():
+        categories[name] = round(sleep_time(stats, caller_name) * 1000, 2)
+    # Vòng lặp / xử lý dòng trong main.py (self time, trừ normalize_date đã tính riêng)
+    categories['app_code'] = round(sum(
+        tt for (filename, _line, name), (_cc, _nc, tt, _ct, _callers) in stats.items()
+        if filename == __file__ and name != 'normalize_date'
+    ) * 1000, 2)
+    
+    top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP_FUNCTIONS]
+    return {
+        'wall_ms': round(wall_time * 1000, 2),
+        'categories_ms': categories,
+        'top_functions': [
+            {
+                'function': f"{os.path.basename(filename)}:{line}({name})",
+                'calls': nc,
+                'self_ms': round(tt * 1000, 3),
+                'cumulative_ms': round(ct * 1000, 3)
+            }
+            for (filename, line, name), (_cc, nc, tt, ct, _callers) in top
+        ]
+    }
+
+@app.before_request
+def start_profiling():
+    if not PROFILE_TOKEN or not should_profile():
+        return
+    
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Đã có profiler khác đang chạy trong tiến trình
+        return
+    g.profiler = profiler
+    g.profile_started = time.perf_counter()
+
+@app.after_request
+def finish_profiling(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    
+    profiler.disable()
+    wall_time = time.perf_counter() - g.profile_started
+    profile = summarize_profile(profiler, wall_time)
+    with profile_lock:
+        profile_counter[0] += 1
+        profile['id'] = profile_counter[0]
+    profile.update({
+        'path': request.path,
+        'tenant': current_tenant().id,
+        'method': request.method,
+        'status': response.status_code,
+        'at': datetime.now().isoformat(timespec='seconds')
+    })
+    recent_profiles.append(profile)
+    
+    response.headers['X-Profile-Id'] = str(profile['id'])
+    print(f"🔬 [PROFILE] {request.path}: {profile['wall_ms']}ms {profile['categories_ms']}")
+    return response
+
+@app.route('/api/profiling', methods=['GET', 'POST', 'DELETE'])
+def profiling_endpoint():
+    """Xem các profile gần đây (GET), bật profile cho một route (POST) hoặc tắt (DELETE)
+
+    POST body: {"path": "/api/get_data", "requests": 5}
+    """
+    if not is_admin_request():
+        return jsonify({'error': 'Không có quyền truy cập'}), 403
+    
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        path = data.get('path', '')
+        try:
+            count = min(int(data.get('requests', 1)), PROFILE_MAX_REQUESTS)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'requests phải là số nguyên'}), 400
+        if not path.startswith('/') or count < 1:
+            return jsonify({'error': 'Cần path (vd. /api/get_data) và requests >= 1'}), 400
+        with profile_lock:
+            profile_targets[path] = count
+    elif request.method == 'DELETE':
+        with profile_lock:
+            profile_targets.clear()
+    
+    with profile_lock:
+        targets = dict(profile_targets)
+    return jsonify({
+        'targets': targets,
+        'profiles': list(reversed(recent_profiles))
+    })
+
 # ==================== GOOGLE SHEETS CONNECTION ====================
+# gspread và google-auth chỉ được import khi kết nối lần đầu để khởi động nhanh;
+# client, spreadsheet và worksheet được giữ lại thay vì xác thực lại mỗi request.
+# Client được dùng chung giữa các tenant có cùng credentials; spreadsheet và
+# worksheet nằm trong Tenant.
+DEFAULT_SHEET_ID = '1i5N5Gdk-SqPN7Vy5IFiHiK5CTCw9WDag2EMZ1GBI8Wo'
+DEFAULT_CREDENTIALS_ENV = 'GOOGLE_SHEETS_CREDENTIALS'
+client_pool = {}  # tên biến môi trường credentials -> client
+client_pool_lock = threading.Lock()
+
+def get_sheet_id():
+    return current_tenant().sheet_id
+
+# Các lời gọi mạng (xác thực, open_by_key, worksheet) chạy ngoài khóa để một
+# request chờ quota/backoff không chặn các request khác; hai luồng cùng mở lần
+# đầu thì chỉ giữ lại kết quả đầu tiên.
 def connect_to_sheets():
+    """Trả về client Google Sheets của tenant hiện tại, chỉ xác thực ở lần gọi đầu tiên"""
+    credentials_env = current_tenant().credentials_env
+    with client_pool_lock:
+        client = client_pool.get(credentials_env)
+    if client is not None:
+        return client
+    
+    client = create_sheets_client(credentials_env)
+    if client is None:
+        return None
+    with client_pool_lock:
+        return client_pool.setdefault(credentials_env, client)
+
+def open_spreadsheet():
+    """Mở spreadsheet một lần (open_by_key tốn một request metadata)"""
+    tenant = current_tenant()
+    with tenant.lock:
+        if tenant.spreadsheet is not None:
+            return tenant.spreadsheet
+    
+    client = connect_to_sheets()
+    if not client:
+        return None
+    spreadsheet = sheets_call(client.open_by_key, tenant.sheet_id)
+    with tenant.lock:
+        if tenant.spreadsheet is None:
+            tenant.spreadsheet = spreadsheet
+        return tenant.spreadsheet
+
+def get_worksheet(sheet_name):
+    """Lấy worksheet theo tên, giữ lại object để không đọc lại metadata"""
+    tenant = current_tenant()
+    with tenant.lock:
+        if sheet_name in tenant.worksheets:
+            return tenant.worksheets[sheet_name]
+    
+    spreadsheet = open_spreadsheet()
+    if not spreadsheet:
+        return None
+    worksheet = sheets_call(spreadsheet.worksheet, sheet_name)
+    with tenant.lock:
+        return tenant.worksheets.setdefault(sheet_name, worksheet)
+
+def reset_sheets_connection():
+    """Bỏ client/spreadsheet đã lưu của tenant hiện tại để lần sau kết nối lại từ đầu"""
+    tenant = current_tenant()
+    with client_pool_lock:
+        client_pool.pop(tenant.credentials_env, None)
+    with tenant.lock:
+        tenant.spreadsheet = None
+        tenant.worksheets.clear()
+
+def create_sheets_client(credentials_env=DEFAULT_CREDENTIALS_ENV):
+    import gspread
+    from google.oauth2.service_account import Credentials
+
     try:
         scopes = [
             "https://www.googleapis.com/auth/spreadsheets",
@@ -112,10 +687,17 @@ def connect_to_sheets():
         ]
         
         # CÁCH 1: Dùng service account JSON từ biến môi trường (Railway)
-        credentials_json = os.environ.get('GOOGLE_SHEETS_CREDENTIALS')
+        # Tenant khai báo biến riêng thì chỉ dùng biến đó: thiếu hoặc lỗi thì
+        # không kết nối, tránh đọc nhầm spreadsheet bằng tài khoản mặc định
+        credentials_json = os.environ.get(credentials_env)
+        dedicated = credentials_env != DEFAULT_CREDENTIALS_ENV
+        
+        if dedicated and not credentials_json:
+            print(f"❌ Thiếu biến môi trường {credentials_env}, không dùng thông tin xác thực mặc định")
+            return None
         
         if credentials_json:
-            print("✅ Đang dùng GOOGLE_SHEETS_CREDENTIALS từ biến môi trường")
+            print(f"✅ Đang dùng {credentials_env} từ biến môi trường")
             try:
                 credentials_info = json.loads(credentials_json)
                 creds = Credentials.from_service_account_info(credentials_info, scopes=scopes)
@@ -124,6 +706,8 @@ def connect_to_sheets():
                 return client
             except Exception as e:
                 print(f"❌ Lỗi parse credentials từ biến môi trường: {e}")
+                if dedicated:
+                    return None
         
         # CÁCH 2: Dùng file service account (local development)
         creds_files = [
@@ -180,6 +764,182 @@ def connect_to_sheets():
         traceback.print_exc()
         return None
 
+# ==================== UPSTREAM PROTECTION ====================
+# Mọi lệnh gọi Google Sheets đi qua sheets_call: giới hạn quota theo phút,
+# retry có backoff + jitter với lỗi 429/5xx, và circuit breaker để không dồn
+# request vào upstream đang lỗi (khi đó get_cached_data trả về dữ liệu cũ).
+SHEETS_QUOTA_PER_MINUTE = int(os.environ.get('SHEETS_QUOTA_PER_MINUTE', '50'))  # Google: 60 read/phút/user
+QUOTA_MAX_WAIT = 5  # Chờ tối đa 5 giây cho quota trước khi báo lỗi
+SHEETS_MAX_RETRIES = 2
+SHEETS_RETRY_BASE = 1.0  # giây
+BREAKER_FAILURE_THRESHOLD = 3  # Số lỗi liên tiếp trước khi mở circuit
+BREAKER_BASE_COOLDOWN = 10  # giây, nhân đôi sau mỗi lần mở lại
+BREAKER_MAX_COOLDOWN = 300
+
+class UpstreamUnavailable(Exception):
+    """Không gọi Google Sheets (circuit đang mở hoặc hết quota)"""
+
+def backoff_delay(attempt, base, cap):
+    """Exponential backoff với jitter: ngẫu nhiên trong [delay/2, delay]"""
+    delay = min(cap, base * (2 ** attempt))
+    return random.uniform(delay / 2, delay)
+
+class QuotaTracker:
+    """Đếm số request Google Sheets trong 60 giây gần nhất"""
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.calls = deque()
+        self.lock = threading.Lock()
+
+    def _prune(self, now):
+        while self.calls and now - self.calls[0] >= 60:
+            self.calls.popleft()
+
+    def acquire(self):
+        """Giữ một suất gọi; hết quota thì chờ (ngoài khóa) tối đa QUOTA_MAX_WAIT rồi kiểm tra lại"""
+        deadline = time.time() + QUOTA_MAX_WAIT
+        while True:
+            with self.lock:
+                now = time.time()
+                self._prune(now)
+                if len(self.calls) < self.per_minute:
+                    self.calls.append(now)
+                    return
+                wait_time = 60 - (now - self.calls[0])
+            
+            if now + wait_time > deadline:
+                raise UpstreamUnavailable(f"Hết quota Google Sheets ({self.per_minute}/phút)")
+            print(f"⏳ [QUOTA] Chờ {wait_time:.1f}s")
+            time.sleep(wait_time)
+
+    def used(self):
+        with self.lock:
+            self._prune(time.time())
+            return len(self.calls)
+
+class CircuitBreaker:
+    """closed -> open sau nhiều lỗi liên tiếp -> half_open (một probe) -> closed"""
+
+    def __init__(self, failure_threshold, base_cooldown, max_cooldown):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.open_count = 0
+        self.open_until = 0
+        self.probe_in_flight = False
+
+    def before_call(self):
+        """Trả về True nếu lệnh gọi này là probe của trạng thái half_open"""
+        with self.lock:
+            if self.state == 'closed':
+                return False
+            if self.state == 'open' and time.time() < self.open_until:
+                raise UpstreamUnavailable(f"Circuit đang mở thêm {self.open_until - time.time():.0f}s")
+            if self.probe_in_flight:
+                raise UpstreamUnavailable("Circuit đang thử lại (half-open)")
+            self.state = 'half_open'
+            self.probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            if self.state != 'closed':
+                print("✅ [CIRCUIT] Google Sheets hoạt động lại, đóng circuit")
+            self.state = 'closed'
+            self.failures = 0
+            self.open_count = 0
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probe_in_flight = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                cooldown = backoff_delay(self.open_count, self.base_cooldown, self.max_cooldown)
+                self.state = 'open'
+                self.open_until = time.time() + cooldown
+                self.open_count += 1
+                print(f"⛔ [CIRCUIT] Mở circuit {cooldown:.0f}s sau {self.failures} lỗi")
+
+    def release_probe(self):
+        with self.lock:
+            self.probe_in_flight = False
+
+    def status(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'retry_in_seconds': max(0, round(self.open_until - time.time(), 1)) if self.state == 'open' else 0
+            }
+
+
+def is_retryable_error(e, idempotent=True):
+    """429 luôn retry được; 5xx / lỗi mạng chỉ retry với lệnh đọc"""
+    status = getattr(getattr(e, 'response', None), 'status_code', None)
+    if status == 429:
+        return True
+    if not idempotent:
+        return False
+    if status is not None:
+        return status >= 500
+    return isinstance(e, OSError)  # requests.RequestException kế thừa IOError
+
+def is_upstream_failure(e):
+    status = getattr(getattr(e, 'response', None), 'status_code', None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(e, OSError)
+
+def probe_sheets(tenant):
+    """Probe rẻ cho half-open: chỉ đọc spreadsheetId"""
+    if tenant.spreadsheet is not None:
+        tenant.quota.acquire()
+        tenant.spreadsheet.fetch_sheet_metadata({'fields': 'spreadsheetId'})
+
+def sheets_call(func, *args, idempotent=True, **kwargs):
+    """Gọi một hàm gspread qua quota, retry và circuit breaker
+
+    Lệnh ghi (idempotent=False) chỉ retry với 429 vì khi đó request chưa được xử lý.
+    Quota và circuit breaker là của tenant hiện tại.
+    """
+    tenant = current_tenant()
+    is_probe = tenant.breaker.before_call()
+    try:
+        if is_probe:
+            probe_sheets(tenant)
+        
+        attempt = 0
+        while True:
+            tenant.quota.acquire()
+            try:
+                result = func(*args, **kwargs)
+                break
+            except Exception as e:
+                if attempt >= SHEETS_MAX_RETRIES or not is_retryable_error(e, idempotent):
+                    raise
+                delay = backoff_delay(attempt, SHEETS_RETRY_BASE, 30)
+                attempt += 1
+                print(f"🔁 [SHEETS] Lỗi {e}, thử lại lần {attempt} sau {delay:.1f}s")
+                time.sleep(delay)
+    except UpstreamUnavailable:
+        tenant.breaker.release_probe()
+        raise
+    except Exception as e:
+        # Lỗi không phải do upstream (vd. sai tên sheet) không làm mở circuit
+        if is_upstream_failure(e):
+            tenant.breaker.record_failure()
+        else:
+            tenant.breaker.record_success()
+        raise
+    
+    tenant.breaker.record_success()
+    return result
+
 def normalize_date(date_str):
     """Chuẩn hóa định dạng ngày từ nhiều định dạng khác nhau"""
     if not date_str:
@@ -220,6 +980,967 @@ def normalize_date(date_str):
     
     return date_str
 
+# ==================== MULTI-TENANT ====================
+# Một tiến trình phục vụ nhiều thư viện / cơ sở. Mỗi tenant có spreadsheet, quota
+# và circuit breaker riêng; khóa cache, snapshot và rate limit có tiền tố tenant.
+# Chọn tenant bằng tiền tố đường dẫn /t/<tenant>/... hoặc header X-Tenant, mặc
+# định là tenant 'default' (SHEET_ID). Cấu hình thêm tenant qua biến TENANTS:
+# {"coso2": {"sheet_id": "...", "credentials_env": "COSO2_CREDENTIALS",
+#            "quota_per_minute": 30, "departments_sheet": "Khoa"}}
+DEFAULT_TENANT = 'default'
+TENANT_SEPARATOR = '::'
+TENANT_PATH_PREFIX = '/t/'
+TENANT_ID_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-')
+DEPARTMENTS_SHEET = os.environ.get('DEPARTMENTS_SHEET', '')  # Sheet chứa danh sách khoa (cột A), tùy chọn
+
+class Tenant:
+    """Cấu hình và trạng thái kết nối Google Sheets của một tenant"""
+    __slots__ = ('id', 'sheet_id', 'credentials_env', 'departments_sheet',
+                 'quota', 'breaker', 'spreadsheet', 'worksheets', 'lock')
+
+    def __init__(self, tenant_id, sheet_id, credentials_env=DEFAULT_CREDENTIALS_ENV,
+                 quota_per_minute=SHEETS_QUOTA_PER_MINUTE, departments_sheet=''):
+        self.id = tenant_id
+        self.sheet_id = sheet_id
+        self.credentials_env = credentials_env
+        self.departments_sheet = departments_sheet
+        self.quota = QuotaTracker(quota_per_minute)
+        self.breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_BASE_COOLDOWN, BREAKER_MAX_COOLDOWN)
+        self.spreadsheet = None
+        self.worksheets = {}
+        self.lock = threading.RLock()
+
+def load_tenants():
+    """Tenant mặc định từ SHEET_ID cùng các tenant khai báo trong TENANTS (JSON)"""
+    tenants = {
+        DEFAULT_TENANT: Tenant(DEFAULT_TENANT, os.environ.get('SHEET_ID', DEFAULT_SHEET_ID),
+                               departments_sheet=DEPARTMENTS_SHEET)
+    }
+    
+    raw_config = os.environ.get('TENANTS', '').strip()
+    if not raw_config:
+        return tenants
+    
+    try:
+        config = json.loads(raw_config)
+        if not isinstance(config, dict):
+            raise ValueError('TENANTS phải là một object JSON')
+    except ValueError as e:
+        print(f"❌ [TENANT] Cấu hình TENANTS không hợp lệ: {e}")
+        return tenants
+    
+    for tenant_id, options in config.items():
+        if not tenant_id or not set(tenant_id) <= TENANT_ID_CHARS or \
+                not isinstance(options, dict) or not options.get('sheet_id'):
+            print(f"⚠️ [TENANT] Bỏ qua tenant không hợp lệ: {tenant_id!r}")
+            continue
+        try:
+            # Biến xác thực riêng chưa đặt: tenant không thể kết nối, không đăng ký
+            # để không giữ cả tiến trình ở trạng thái chưa sẵn sàng
+            credentials_env = options.get('credentials_env', DEFAULT_CREDENTIALS_ENV)
+            if credentials_env != DEFAULT_CREDENTIALS_ENV and not os.environ.get(credentials_env):
+                print(f"❌ [TENANT] Bỏ qua tenant {tenant_id}: chưa đặt biến {credentials_env}")
+                continue
+            tenants[tenant_id] = Tenant(
+                tenant_id, options['sheet_id'],
+                credentials_env=credentials_env,
+                quota_per_minute=int(options.get('quota_per_minute', SHEETS_QUOTA_PER_MINUTE)),
+                departments_sheet=options.get('departments_sheet', '')
+            )
+        except (TypeError, ValueError) as e:
+            print(f"⚠️ [TENANT] Bỏ qua tenant {tenant_id}: {e}")
+    
+    print(f"🏢 [TENANT] {len(tenants)} tenant: {', '.join(sorted(tenants))}")
+    return tenants
+
+tenants = load_tenants()
+tenant_local = threading.local()
+
+def current_tenant():
+    """Tenant của luồng nền đang xử lý (use_tenant) hoặc của request hiện tại"""
+    tenant = getattr(tenant_local, 'tenant', None)
+    if tenant is None and has_request_context():
+        tenant = g.get('tenant')
+    return tenant or tenants[DEFAULT_TENANT]
+
+@contextmanager
+def use_tenant(tenant):
+    """Chạy code ngoài request (warm-up, job nền) cho một tenant"""
+    previous = getattr(tenant_local, 'tenant', None)
+    tenant_local.tenant = tenant
+    try:
+        yield tenant
+    finally:
+        tenant_local.tenant = previous
+
+def tenant_key(name):
+    """Khóa cache/snapshot theo tenant; tenant mặc định giữ nguyên tên sheet"""
+    tenant_id = current_tenant().id
+    if tenant_id == DEFAULT_TENANT:
+        return name
+    return f"{tenant_id}{TENANT_SEPARATOR}{name}"
+
+def split_tenant_key(key):
+    """'coso2::Data' -> ('coso2', 'Data'); khóa không có tiền tố thuộc tenant mặc định"""
+    tenant_id, separator, name = key.partition(TENANT_SEPARATOR)
+    if separator and tenant_id != DEFAULT_TENANT and tenant_id in tenants:
+        return tenant_id, name
+    return DEFAULT_TENANT, key
+
+class TenantPathMiddleware:
+    """/t/<tenant>/api/... -> /api/... với SCRIPT_NAME=/t/<tenant> để link và fetch giữ tiền tố"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path.startswith(TENANT_PATH_PREFIX):
+            tenant_id, _, rest = path[len(TENANT_PATH_PREFIX):].partition('/')
+            if tenant_id in tenants:
+                environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + TENANT_PATH_PREFIX + tenant_id
+                environ['PATH_INFO'] = '/' + rest
+                environ['phonghocnhom.tenant'] = tenant_id
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = TenantPathMiddleware(app.wsgi_app)
+
+@app.before_request
+def resolve_tenant():
+    tenant_id = (request.environ.get('phonghocnhom.tenant') or
+                 request.headers.get('X-Tenant', '').strip() or DEFAULT_TENANT)
+    tenant = tenants.get(tenant_id)
+    if tenant is None:
+        return jsonify({'error': f'Không tìm thấy tenant: {tenant_id}'}), 404
+    g.tenant = tenant
+
+# ==================== RECORD TYPES ====================
+# Mỗi dòng sheet được parse một lần khi nạp cache thành record dùng __slots__,
+# các route đọc thuộc tính thay vì row[6], row[10] và kiểm tra len(row) mỗi lần.
+UNDATED = 'undated'  # Ngày không có dạng dd/mm/yyyy: luôn qua bộ lọc ngày
+INVALID_DATE = 'invalid'  # Có '/' nhưng không parse được: bị loại khi lọc theo ngày
+
+class Record:
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__
+        )
+
+    def __repr__(self):
+        fields = ', '.join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+int_pool = {}
+
+def shared_int(value):
+    """Dùng chung object int cho ordinal ngày, khóa tháng, phút (số > 256 không được Python cache)"""
+    return int_pool.setdefault(value, value)
+
+def make_month_key(year, month):
+    """(năm, tháng) -> năm * 12 + tháng - 1, None nếu tháng không hợp lệ"""
+    if not 1 <= month <= 12:
+        return None
+    return shared_int(year * 12 + month - 1)
+
+class CheckIn(Record):
+    """Một lượt sử dụng phòng (sheet Data, cột A..K)
+
+    Giữ lại các ô gốc của sheet (dùng chung string với dòng đã đọc) và chỉ thêm
+    các khóa số nhỏ; số lượng và trạng thái đủ cột được tính khi cần.
+    """
+    __slots__ = (
+        'mssv', 'khoavien', 'phong', 'soluong', 'check_in', 'check_out', 'date_raw',
+        'floor', 'month_label', 'room_label', 'nguoi_nhap',
+        'date', 'day', 'date_month', 'label_month', 'in_minute', 'out_minute'
+    )
+
+    def __init__(self, row):
+        # Các cột lặp lại nhiều (khoa, phòng, giờ, ngày, vị trí, người nhập) được
+        # intern để mọi dòng dùng chung một string thay vì mỗi dòng một bản
+        intern = sys.intern
+        self.mssv, self.khoavien, self.phong, self.soluong = row[0], intern(row[1]), intern(row[2]), intern(row[3])
+        self.check_in, self.check_out, self.date_raw = intern(row[4]), intern(row[5]), intern(row[6])
+        # Các dòng cũ có thể thiếu cột H..K (None, xem complete)
+        if len(row) >= 11:
+            self.floor, self.month_label = intern(row[7]), intern(row[8])
+            self.room_label, self.nguoi_nhap = intern(row[9]), intern(row[10])
+        else:
+            self.floor = self.month_label = self.room_label = self.nguoi_nhap = None
+
+        # Ngày đã đúng định dạng thì dùng chung string với ô gốc, ngược lại intern
+        # (nhiều dòng cùng một ngày)
+        normalized = normalize_date(self.date_raw)
+        self.date = self.date_raw if normalized == self.date_raw else sys.intern(normalized)
+        self.day, self.date_month = parse_day(self.date)
+        self.label_month = parse_month_label(self.month_label)
+        self.in_minute = parse_minute(self.check_in)
+        self.out_minute = parse_minute(self.check_out)
+
+    @property
+    def complete(self):
+        return self.nguoi_nhap is not None
+
+    @property
+    def quantity(self):
+        try:
+            return int(float(self.soluong)) if self.soluong else 0
+        except (ValueError, OverflowError):
+            return 0
+
+    def as_row(self):
+        if not self.complete:
+            return [self.mssv, self.khoavien, self.phong, self.soluong, self.check_in,
+                    self.check_out, self.date_raw, '', '', '', '']
+        return [self.mssv, self.khoavien, self.phong, self.soluong, self.check_in,
+                self.check_out, self.date_raw, self.floor, self.month_label,
+                self.room_label, self.nguoi_nhap]
+
+class Booking(Record):
+    """Một lượt đăng ký phòng (sheet Data1, cột A..G)"""
+    __slots__ = ('mssv', 'khoavien', 'phong', 'soluong', 'time', 'date_raw', 'floor', 'date')
+
+    def __init__(self, row):
+        self.mssv, self.khoavien, self.phong, self.soluong, self.time, self.date_raw = row[:6]
+        self.floor = row[6] if len(row) > 6 else ''
+        self.date = normalize_date(self.date_raw)
+
+    def as_row(self):
+        return [self.mssv, self.khoavien, self.phong, self.soluong, self.time, self.date_raw]
+
+class Student(Record):
+    """Một sinh viên trong LISTDS"""
+    __slots__ = ('mssv', 'khoavien', 'clean_mssv')
+
+    def __init__(self, row):
+        self.mssv = row[0]
+        self.khoavien = row[1] if len(row) > 1 else None
+        self.clean_mssv = self.mssv.replace("'", "")
+
+class SheetTable:
+    """Dữ liệu một sheet đã parse: header, record hợp lệ và số dòng gốc"""
+    __slots__ = ('header', 'records', 'row_count', 'keys', 'index', 'fetched_at')
+
+    def __init__(self, header, records, row_count, keys=None, index=None):
+        self.header = header
+        self.records = records
+        self.row_count = row_count  # Số dòng dữ liệu trên sheet (không tính header)
+        self.keys = keys
+        self.index = index
+        self.fetched_at = 0.0  # Thời điểm lấy từ Google Sheets (gán trong store_in_cache)
+
+class DateIndex:
+    """Phân vùng vị trí record theo ngày và theo tháng
+
+    Truy vấn "hôm nay", "tháng này" hay một khoảng ngày chỉ chạm các phân vùng
+    liên quan thay vì duyệt toàn bộ lịch sử.
+    """
+    __slots__ = ('by_day', 'days', 'by_month', 'by_any_month', 'undated')
+
+    def __init__(self, records):
+        by_day = {}  # ordinal -> [vị trí record]
+        by_month = {}  # khóa tháng theo cột ngày (G)
+        by_any_month = {}  # khóa tháng theo cột ngày (G) hoặc cột tháng (I)
+        undated = []
+        
+        for position, record in enumerate(records):
+            if record.day == UNDATED:
+                undated.append(position)
+            elif record.day != INVALID_DATE:
+                by_day.setdefault(record.day, []).append(position)
+            
+            if record.date_month is not None:
+                by_month.setdefault(record.date_month, []).append(position)
+            for month_key in {record.date_month, record.label_month}:
+                if month_key is not None:
+                    by_any_month.setdefault(month_key, []).append(position)
+        
+        # Vị trí lưu dạng array 4 byte thay vì list các object int
+        self.by_day = {key: array('I', positions) for key, positions in by_day.items()}
+        self.by_month = {key: array('I', positions) for key, positions in by_month.items()}
+        self.by_any_month = {key: array('I', positions) for key, positions in by_any_month.items()}
+        self.undated = undated
+        self.days = sorted(self.by_day)
+
+    def day(self, ordinal):
+        return self.by_day.get(ordinal, [])
+
+    def month(self, month_key):
+        return self.by_month.get(month_key, [])
+
+    def any_month(self, month_key):
+        return self.by_any_month.get(month_key, [])
+
+    def day_range(self, start_ord=None, end_ord=None):
+        """Vị trí record có ngày trong [start_ord, end_ord], None là không giới hạn"""
+        low = 0 if start_ord is None else bisect.bisect_left(self.days, start_ord)
+        high = len(self.days) if end_ord is None else bisect.bisect_right(self.days, end_ord)
+        positions = []
+        for day_key in self.days[low:high]:
+            positions.extend(self.by_day[day_key])
+        return positions
+
+def parse_day(normalized_date):
+    """Trả về (ordinal hoặc UNDATED/INVALID_DATE, khóa tháng hoặc None)"""
+    if '/' not in normalized_date:
+        return UNDATED, None
+    
+    try:
+        day, month, year = normalized_date.split('/')
+        year, month = int(year), int(month)
+    except ValueError:
+        return INVALID_DATE, None
+    
+    month_key = make_month_key(year, month)
+    try:
+        return shared_int(date(year, month, int(day)).toordinal()), month_key
+    except (ValueError, OverflowError):
+        return INVALID_DATE, month_key
+
+def parse_minute(value):
+    """'HH:MM' hoặc 'HH:MM:SS' -> phút trong ngày, None nếu không hợp lệ"""
+    if ':' not in value:
+        return None
+    
+    parts = value.strip().split(':')
+    if len(parts) > 3:
+        return None
+    try:
+        hour, minute = int(parts[0]), int(parts[1])
+    except ValueError:
+        return None
+    if 0 <= hour < 24 and 0 <= minute < 60:
+        return shared_int(hour * 60 + minute)
+    return None
+
+def parse_month_label(label):
+    """'Tháng 3 năm 2025' -> khóa tháng của 3/2025"""
+    if label and "Tháng" in label:
+        parts = label.split()
+        if len(parts) >= 4:
+            try:
+                return make_month_key(int(parts[3]), int(parts[1]))
+            except ValueError:
+                pass
+    return None
+
+def _parse_table(rows, record_type, min_columns):
+    header = rows[0] if rows else []
+    records = [record_type(row) for row in rows[1:] if len(row) >= min_columns]
+    skipped = len(rows) - 1 - len(records)
+    if skipped > 0:
+        print(f"⚠️ [PARSE] Bỏ qua {skipped} dòng thiếu cột ({record_type.__name__})")
+    return SheetTable(header, records, max(len(rows) - 1, 0))
+
+def parse_checkins(rows):
+    table = _parse_table(rows, CheckIn, 7)
+    table.index = DateIndex(table.records)
+    return table
+
+def parse_bookings(rows):
+    return _parse_table(rows, Booking, 6)
+
+def parse_students(rows):
+    table = _parse_table(rows, Student, 1)
+    table.keys = {student.clean_mssv for student in table.records}
+    return table
+
+SHEET_PARSERS = {
+    'Data': parse_checkins,
+    'Data1': parse_bookings,
+    'LISTDS': parse_students
+}
+
+def get_checkins(cache_duration=10):
+    return get_cached_data('Data', cache_duration)
+
+def get_bookings(cache_duration=10):
+    return get_cached_data('Data1', cache_duration)
+
+def get_students(cache_duration=10):
+    return get_cached_data('LISTDS', cache_duration)
+
+# ==================== REPORT ENGINE (SQLITE) ====================
+# Bảng tổng hợp được lưu trong SQLite (mặc định trong bộ nhớ của mỗi worker) với
+# index theo ngày/tháng, vị trí, phòng, người nhập; mọi báo cáo là một truy vấn
+# GROUP BY có tham số. Khi REPORT_DB là file dùng chung giữa các worker, mốc đã
+# ingest (số dòng + hash dòng cuối + thời điểm lấy bản Data) nằm trong bảng
+# rollup_meta và được cập nhật trong cùng transaction với các upsert, nên mỗi
+# dòng chỉ được cộng một lần.
+REPORT_DB = os.environ.get('REPORT_DB', ':memory:')
+ROLLUP_DAILY_DAYS = int(os.environ.get('ROLLUP_DAILY_DAYS', '92'))  # Giữ chi tiết theo ngày ~3 tháng
+ROLLUP_REBUILD_INTERVAL = 600  # Dựng lại toàn bộ định kỳ để bắt các dòng bị sửa trên sheet
+
+def month_key_of(ordinal):
+    d = date.fromordinal(ordinal)
+    return make_month_key(d.year, d.month)
+
+def month_bounds(month_key):
+    """Ordinal ngày đầu và ngày cuối của tháng"""
+    year, month = divmod(month_key, 12)
+    first = date(year, month + 1, 1).toordinal()
+    next_year, next_month = divmod(month_key + 1, 12)
+    return first, date(next_year, next_month + 1, 1).toordinal() - 1
+
+ROLLUP_COLUMNS = 'faculty, floor, room, staff'
+
+class ReportEngine:
+    """Tổng hợp (count, sum số lượng) theo (ngày, khoa, vị trí, phòng, người nhập)
+
+    Cập nhật tăng dần khi sheet Data có thêm dòng; ngày cũ hơn ROLLUP_DAILY_DAYS
+    được gộp theo tháng (rollup_monthly). Dòng không có ngày / ngày sai nằm
+    trong rollup_other.
+    """
+
+    SCHEMA = f"""
+        CREATE TABLE IF NOT EXISTS rollup_daily (
+            day INTEGER, faculty TEXT, floor TEXT, room TEXT, staff TEXT,
+            cnt INTEGER, total INTEGER,
+            PRIMARY KEY (day, {ROLLUP_COLUMNS})
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS rollup_monthly (
+            month INTEGER, faculty TEXT, floor TEXT, room TEXT, staff TEXT,
+            cnt INTEGER, total INTEGER,
+            PRIMARY KEY (month, {ROLLUP_COLUMNS})
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS rollup_other (
+            kind TEXT, faculty TEXT, floor TEXT, room TEXT, staff TEXT,
+            cnt INTEGER, total INTEGER,
+            PRIMARY KEY (kind, {ROLLUP_COLUMNS})
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS rollup_meta (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            record_count INTEGER, last_hash TEXT, fetched_at REAL, built_at REAL,
+            compact_before INTEGER
+        );
+        INSERT OR IGNORE INTO rollup_meta VALUES (1, 0, NULL, 0, 0, 0);
+        CREATE INDEX IF NOT EXISTS idx_daily_floor ON rollup_daily (floor, day);
+        CREATE INDEX IF NOT EXISTS idx_daily_room ON rollup_daily (room, day);
+        CREATE INDEX IF NOT EXISTS idx_daily_staff ON rollup_daily (staff, day);
+        CREATE INDEX IF NOT EXISTS idx_daily_faculty ON rollup_daily (faculty, day);
+        CREATE INDEX IF NOT EXISTS idx_monthly_floor ON rollup_monthly (floor, month);
+        CREATE INDEX IF NOT EXISTS idx_monthly_room ON rollup_monthly (room, month);
+        CREATE INDEX IF NOT EXISTS idx_monthly_staff ON rollup_monthly (staff, month);
+        CREATE INDEX IF NOT EXISTS idx_monthly_faculty ON rollup_monthly (faculty, month);
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        # Tự quản lý transaction (BEGIN IMMEDIATE) để các process ghi lần lượt
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.executescript(self.SCHEMA)
+        self.source = None
+        self.compact_before = 0  # Ordinal ngày đầu tháng; trước đó chỉ giữ theo tháng
+
+    @staticmethod
+    def record_hash(record):
+        return hashlib.sha1('\x1f'.join(record.as_row()).encode('utf-8')).hexdigest()
+
+    def _read_meta(self):
+        record_count, last_hash, fetched_at, built_at, compact_before = self.db.execute(
+            "SELECT record_count, last_hash, fetched_at, built_at, compact_before FROM rollup_meta WHERE id = 1"
+        ).fetchone()
+        self.compact_before = compact_before
+        return record_count, last_hash, fetched_at, built_at
+
+    def _bucket_of(self, day_key):
+        if day_key in (UNDATED, INVALID_DATE):
+            return 'rollup_other', 'kind', day_key
+        if day_key < self.compact_before:
+            return 'rollup_monthly', 'month', month_key_of(day_key)
+        return 'rollup_daily', 'day', day_key
+
+    def _ingest(self, checkins):
+        """Gộp các lượt trong Python rồi upsert theo lô vào từng bảng"""
+        batches = {}
+        for checkin in checkins:
+            if not checkin.complete:
+                continue
+            table, column, bucket = self._bucket_of(checkin.day)
+            key = (bucket, checkin.khoavien, checkin.floor, checkin.phong, checkin.nguoi_nhap)
+            cell = batches.setdefault((table, column), {}).setdefault(key, [0, 0])
+            cell[0] += 1
+            cell[1] += checkin.quantity
+        
+        for (table, column), cells in batches.items():
+            self.db.executemany(
+                f"INSERT INTO {table} ({column}, {ROLLUP_COLUMNS}, cnt, total) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                f"ON CONFLICT DO UPDATE SET cnt = cnt + excluded.cnt, total = total + excluded.total",
+                [key + (count, total) for key, (count, total) in cells.items()]
+            )
+
+    def _compact(self):
+        """Gộp các ngày cũ vào bảng tháng"""
+        cutoff = date.today() - timedelta(days=ROLLUP_DAILY_DAYS)
+        compact_before = cutoff.replace(day=1).toordinal()
+        if compact_before <= self.compact_before:
+            return
+        
+        self.compact_before = compact_before
+        self.db.execute("UPDATE rollup_meta SET compact_before = ? WHERE id = 1", (compact_before,))
+        old_days = self.db.execute(
+            "SELECT DISTINCT day FROM rollup_daily WHERE day < ?", (compact_before,)
+        ).fetchall()
+        for (day_key,) in old_days:
+            self.db.execute(
+                f"INSERT INTO rollup_monthly (month, {ROLLUP_COLUMNS}, cnt, total) "
+                f"SELECT ?, {ROLLUP_COLUMNS}, cnt, total FROM rollup_daily WHERE day = ? "
+                f"ON CONFLICT DO UPDATE SET cnt = cnt + excluded.cnt, total = total + excluded.total",
+                (month_key_of(day_key), day_key)
+            )
+        self.db.execute("DELETE FROM rollup_daily WHERE day < ?", (compact_before,))
+
+    def _reset(self):
+        for table in ('rollup_daily', 'rollup_monthly', 'rollup_other'):
+            self.db.execute(f"DELETE FROM {table}")
+        self.compact_before = 0
+        self.db.execute("UPDATE rollup_meta SET compact_before = 0 WHERE id = 1")
+
+    def update(self, checkins):
+        """Đồng bộ với bảng Data mới nhất, chỉ xử lý các record mới nếu có thể"""
+        with self.lock:
+            if checkins is self.source:
+                return
+            
+            records = checkins.records
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                record_count, last_hash, fetched_at, built_at = self._read_meta()
+                fresh = time.time() - built_at < ROLLUP_REBUILD_INTERVAL
+                prefix_matches = (
+                    0 < record_count <= len(records) and
+                    self.record_hash(records[record_count - 1]) == last_hash
+                )
+                if fetched_at > checkins.fetched_at:
+                    # Worker khác đã ingest bản Data lấy sau bản đang có ở đây
+                    new_records = None
+                elif fresh and prefix_matches:
+                    new_records = records[record_count:]
+                    if new_records:
+                        print(f"📈 [REPORT DB] Cập nhật {len(new_records)} dòng mới")
+                else:
+                    self._reset()
+                    self._compact()
+                    built_at = time.time()
+                    new_records = records
+                    print(f"📈 [REPORT DB] Dựng lại từ {len(new_records)} dòng")
+                
+                if new_records is not None:
+                    self._ingest(new_records)
+                    self._compact()
+                    self.db.execute(
+                        "UPDATE rollup_meta SET record_count = ?, last_hash = ?, fetched_at = ?, built_at = ? "
+                        "WHERE id = 1",
+                        (len(records), self.record_hash(records[-1]) if records else None,
+                         checkins.fetched_at, built_at)
+                    )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            
+            self.source = checkins
+
+    def query(self, start_ord=None, end_ord=None, staff_code='', location=''):
+        """Tổng hợp {khoa: [count, sum]} theo bộ lọc của trang báo cáo
+
+        Tháng đã gộp nhưng chỉ nằm một phần trong khoảng ngày được trả về trong
+        partial_months để tính lại từ dữ liệu gốc.
+        """
+        date_filter = start_ord is not None or end_ord is not None
+        low = start_ord if start_ord is not None else 1
+        high = end_ord if end_ord is not None else date(9999, 1, 1).toordinal() - 1
+        if low > high:
+            return {}, []
+        
+        # Các tháng nằm trọn trong khoảng lọc và các tháng bị cắt ở hai đầu
+        low_month, high_month = month_key_of(low), month_key_of(high)
+        full_low = low_month if month_bounds(low_month)[0] >= low else low_month + 1
+        full_high = high_month if month_bounds(high_month)[1] <= high else high_month - 1
+        
+        filters = ''
+        params = []
+        if staff_code:
+            filters += ' AND staff = ?'
+            params.append(staff_code)
+        if location:
+            filters += ' AND floor = ?'
+            params.append(location)
+        
+        kinds = (UNDATED,) if date_filter else (UNDATED, INVALID_DATE)
+        sql = (
+            f"SELECT faculty, SUM(cnt), SUM(total) FROM ("
+            f" SELECT faculty, cnt, total FROM rollup_daily WHERE day BETWEEN ? AND ?{filters}"
+            f" UNION ALL"
+            f" SELECT faculty, cnt, total FROM rollup_monthly WHERE month BETWEEN ? AND ?{filters}"
+            f" UNION ALL"
+            f" SELECT faculty, cnt, total FROM rollup_other"
+            f" WHERE kind IN ({', '.join('?' * len(kinds))}){filters}"
+            f") GROUP BY faculty"
+        )
+        sql_params = [low, high, *params, full_low, full_high, *params, *kinds, *params]
+        
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self._read_meta()
+                totals = {faculty: [count, total] for faculty, count, total in self.db.execute(sql, sql_params)}
+            finally:
+                self.db.execute("COMMIT")
+            compact_month = month_key_of(self.compact_before) if self.compact_before else None
+        
+        partial_months = []
+        if compact_month is not None:
+            for month_key in sorted({low_month, high_month}):
+                if month_key < compact_month and not full_low <= month_key <= full_high:
+                    first, last = month_bounds(month_key)
+                    partial_months.append((max(first, low), min(last, high)))
+        
+        return totals, partial_months
+
+report_engines = {}  # tenant -> ReportEngine
+report_engines_lock = threading.Lock()
+
+def report_db_path(tenant_id):
+    """Tenant khác mặc định dùng file riêng (vd. reports.db -> reports-coso2.db)"""
+    if tenant_id == DEFAULT_TENANT or REPORT_DB == ':memory:':
+        return REPORT_DB
+    root, ext = os.path.splitext(REPORT_DB)
+    return f"{root}-{tenant_id}{ext}"
+
+def get_report_engine():
+    tenant_id = current_tenant().id
+    with report_engines_lock:
+        if tenant_id not in report_engines:
+            report_engines[tenant_id] = ReportEngine(report_db_path(tenant_id))
+        return report_engines[tenant_id]
+
+def sum_partial_months(checkins, ranges, staff_code, location, totals):
+    """Cộng các lượt thuộc phần tháng đã gộp mà rollup không tách được theo ngày"""
+    records = checkins.records
+    for first, last in ranges:
+        for position in checkins.index.day_range(first, last):
+            checkin = records[position]
+            if not report_row_matches(checkin, None, None, staff_code, location):
+                continue
+            cell = totals.setdefault(checkin.khoavien, [0, 0])
+            cell[0] += 1
+            cell[1] += checkin.quantity
+
+def parse_report_dates(start_date_str, end_date_str):
+    """Chuyển startDate/endDate (YYYY-MM-DD) thành ordinal, None nếu bỏ trống"""
+    start_ord = datetime.strptime(start_date_str, '%Y-%m-%d').toordinal() if start_date_str else None
+    end_ord = datetime.strptime(end_date_str, '%Y-%m-%d').toordinal() if end_date_str else None
+    return start_ord, end_ord
+
+def report_row_matches(checkin, start_ord, end_ord, staff_code, location):
+    """Bộ lọc của trang báo cáo áp dụng cho một CheckIn"""
+    if not checkin.complete:
+        return False
+    if staff_code and checkin.nguoi_nhap != staff_code:
+        return False
+    if location and checkin.floor != location:
+        return False
+    
+    day_key = checkin.day
+    if start_ord is None and end_ord is None or day_key == UNDATED:
+        return True
+    if day_key == INVALID_DATE:
+        return False
+    if start_ord is not None and day_key < start_ord:
+        return False
+    if end_ord is not None and day_key > end_ord:
+        return False
+    return True
+
+def report_totals(checkins, start_ord, end_ord, staff_code, location):
+    """{khoa: [count, sum]} cho bộ lọc báo cáo, dùng chung cho get_report_data và usage-statistics"""
+    engine = get_report_engine()
+    engine.update(checkins)
+    totals, partial_months = engine.query(start_ord, end_ord, staff_code, location)
+    if partial_months:
+        sum_partial_months(checkins, partial_months, staff_code, location, totals)
+    return totals
+
+# ==================== REFERENCE DATA ====================
+# Dữ liệu ít thay đổi (danh sách người nhập, khoa viện) được giữ lâu và chỉ tải
+# lại khi version của file trên Drive thay đổi. Việc kiểm tra version tốn một
+# request Drive nhỏ mỗi phút, gọi thẳng qua session của client (không đi qua
+# sheets_call) nên không tốn quota đọc và không làm mở circuit breaker của
+# Google Sheets. Các lời gọi mạng và loader đều chạy ngoài reference_lock.
+REFERENCE_TTL = int(os.environ.get('REFERENCE_TTL', str(6 * 3600)))  # Tối đa 6 giờ
+REFERENCE_MIN_RELOAD = 300  # File đổi liên tục khi có lượt mới -> tải lại tối đa 5 phút/lần
+REVISION_CHECK_INTERVAL = 60
+REVISION_TIMEOUT = 5  # giây
+DRIVE_FILES_URL = 'https://www.googleapis.com/drive/v3/files/'
+
+reference_cache = {}  # (tenant, name) -> (value, revision, loaded_at)
+revision_state = {}  # tenant -> {'revision', 'checked_at'}
+reference_lock = threading.Lock()
+
+# Danh sách khoa viện mặc định
+DEPARTMENTS = [
+    'Khoa Công nghệ Cơ khí',
+    'Khoa Công nghệ Thông tin',
+    'Khoa Công nghệ Điện',
+    'Khoa Công nghệ Điện tử',
+    'Khoa Công nghệ Động lực',
+    'Khoa Công nghệ Nhiệt - Lạnh',
+    'Khoa Công nghệ May - Thời trang',
+    'Khoa Công nghệ Hóa học',
+    'Khoa Ngoại ngữ',
+    'Khoa Quản trị Kinh doanh',
+    'Khoa Thương mại - Du lịch',
+    'Khoa Kỹ thuật Xây dựng',
+    'Khoa Luật',
+    'Viện Tài chính - Kế toán',
+    'Viện Công nghệ Sinh học và Thực phẩm',
+    'Viện Khoa học Công nghệ và Quản lý Môi trường',
+    'Khoa Khoa học Cơ bản'
+]
+
+def fetch_drive_version(client):
+    """Đọc version file trên Drive; lỗi thì trả về None (chỉ là kiểm tra phụ)"""
+    try:
+        response = client.session.get(DRIVE_FILES_URL + get_sheet_id(),
+                                      params={'fields': 'version', 'supportsAllDrives': 'true'},
+                                      timeout=REVISION_TIMEOUT)
+        response.raise_for_status()
+        return response.json().get('version')
+    except Exception as e:
+        print(f"⚠️ [REFERENCE] Không kiểm tra được version spreadsheet: {e}")
+        return None
+
+def get_spreadsheet_revision():
+    """Version của spreadsheet trên Drive, kiểm tra tối đa mỗi REVISION_CHECK_INTERVAL giây"""
+    tenant_id = current_tenant().id
+    now = time.time()
+    with reference_lock:
+        state = revision_state.setdefault(tenant_id, {'revision': None, 'checked_at': 0})
+        if now - state['checked_at'] < REVISION_CHECK_INTERVAL:
+            return state['revision']
+        # Đánh dấu trước để các luồng khác dùng version cũ thay vì cùng gọi Drive
+        state['checked_at'] = now
+    
+    client = connect_to_sheets()
+    revision = fetch_drive_version(client) if client else None
+    with reference_lock:
+        if revision is not None:
+            state['revision'] = revision
+        return state['revision']
+
+def get_reference_data(name, loader):
+    """Lấy dữ liệu tham chiếu từ cache dài hạn, tải lại khi spreadsheet đổi version
+
+    Nếu tải lại lỗi thì dùng giá trị cũ (nếu có).
+    """
+    cache_key = (current_tenant().id, name)
+    with reference_lock:
+        entry = reference_cache.get(cache_key)
+    
+    now = time.time()
+    revision = get_spreadsheet_revision()
+    if entry:
+        value, loaded_revision, loaded_at = entry
+        age = now - loaded_at
+        if age < REFERENCE_TTL:
+            if revision is None or revision == loaded_revision or age < REFERENCE_MIN_RELOAD:
+                return value
+    
+    try:
+        value = loader()
+    except Exception as e:
+        if entry:
+            print(f"⚠️ [REFERENCE] Lỗi tải {name}, dùng bản cũ: {e}")
+            return entry[0]
+        raise
+    
+    with reference_lock:
+        reference_cache[cache_key] = (value, revision, now)
+    print(f"📚 [REFERENCE] Đã tải {name} (version {revision})")
+    return value
+
+def load_staff_roster():
+    """Cột D của LISTDS: mã người nhập (dòng 2..21)"""
+    rows = fetch_projection('LISTDS', [3], 2, 21)
+    return [row[0] for row in rows if row[0]]
+
+def load_departments():
+    rows = fetch_projection(current_tenant().departments_sheet, [0], 2)
+    names = [row[0].strip() for row in rows if row[0].strip()]
+    return names or list(DEPARTMENTS)
+
+def get_staff_roster():
+    return get_reference_data('staff_roster', load_staff_roster)
+
+def get_departments():
+    if not current_tenant().departments_sheet:
+        return DEPARTMENTS
+    
+    try:
+        return get_reference_data('departments', load_departments)
+    except Exception as e:
+        print(f"⚠️ [REFERENCE] Dùng danh sách khoa mặc định: {e}")
+        return DEPARTMENTS
+
+def clear_reference_cache():
+    tenant_id = current_tenant().id
+    with reference_lock:
+        for cache_key in [key for key in reference_cache if key[0] == tenant_id]:
+            del reference_cache[cache_key]
+        revision_state.pop(tenant_id, None)
+
+# ==================== IDEMPOTENCY (CHỐNG GHI TRÙNG) ====================
+# Bấm gửi 2 lần hoặc trình duyệt gửi lại sau một append_row chậm sẽ tạo dòng trùng.
+# Route ghi nhận header Idempotency-Key; kết quả được lưu ngắn hạn và lần gửi
+# lại nhận đúng kết quả cũ mà không ghi Sheets thêm lần nữa. Bảng khóa nằm
+# trong file SQLite dùng chung để lần gửi lại rơi vào worker khác vẫn nhận ra.
+IDEMPOTENCY_DB = os.environ.get('IDEMPOTENCY_DB', os.path.join(SNAPSHOT_DIR, 'idempotency.db'))
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600))
+IDEMPOTENCY_AUTO_WINDOW = 5  # Không có khóa: cùng nội dung trong 5 giây coi là gửi trùng
+IDEMPOTENCY_WAIT = 15  # Thời gian chờ request cùng khóa đang xử lý
+IDEMPOTENCY_MAX_KEY = 200
+
+class IdempotencyStore:
+    """Bảng (khóa -> kết quả) trong SQLite; dòng có status NULL là đang xử lý"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connect()
+
+    def connect(self):
+        """Mở (lại) kết nối; gọi lại trong process con sau fork"""
+        if self.path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS idempotency (
+                key TEXT PRIMARY KEY, fingerprint TEXT, status INTEGER, body TEXT, expires REAL
+            )
+        """)
+        self.db.commit()
+        self.last_purge = 0
+
+    def claim(self, key, fingerprint):
+        """Giữ khóa cho request hiện tại
+
+        Trả về ('new', None) nếu được xử lý, ('pending', None) nếu request khác
+        đang giữ khóa, ('done', (status, body)) nếu đã có kết quả, hoặc
+        ('mismatch', None) nếu khóa đã dùng cho nội dung khác.
+        """
+        now = time.time()
+        with self.lock, self.db:
+            if now - self.last_purge > 60:
+                self.db.execute("DELETE FROM idempotency WHERE expires < ?", (now,))
+                self.last_purge = now
+            else:
+                self.db.execute("DELETE FROM idempotency WHERE key = ? AND expires < ?", (key, now))
+            
+            # Khóa đang xử lý tự hết hạn nếu worker chết giữa chừng
+            inserted = self.db.execute(
+                "INSERT OR IGNORE INTO idempotency (key, fingerprint, expires) VALUES (?, ?, ?)",
+                (key, fingerprint, now + IDEMPOTENCY_WAIT * 4)
+            ).rowcount
+            if inserted:
+                return 'new', None
+            
+            row = self.db.execute(
+                "SELECT fingerprint, status, body FROM idempotency WHERE key = ?", (key,)
+            ).fetchone()
+        
+        if row is None:
+            return 'pending', None
+        if row[0] != fingerprint:
+            return 'mismatch', None
+        if row[1] is None:
+            return 'pending', None
+        return 'done', (row[1], row[2])
+
+    def complete(self, key, status, body, ttl):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE idempotency SET status = ?, body = ?, expires = ? WHERE key = ?",
+                (status, body, time.time() + ttl, key)
+            )
+
+    def release(self, key):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM idempotency WHERE key = ?", (key,))
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM idempotency").fetchone()[0]
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_DB)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=idempotency_store.connect)
+
+def mark_written(result):
+    """Route gọi ngay sau khi ghi Sheets thành công, với kết quả sẽ trả về
+
+    Từ đây khóa luôn được lưu với kết quả thành công, kể cả khi bước phụ phía
+    sau lỗi, để lần gửi lại không ghi thêm dòng.
+    """
+    g.idempotent_result = result
+
+def idempotent_write(view):
+    """Bọc route ghi dữ liệu: gửi lại cùng Idempotency-Key trả về kết quả đã lưu
+
+    Lỗi 5xx xảy ra trước khi ghi được dữ liệu không được lưu để client có thể
+    thử lại với cùng khóa.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        fingerprint = hashlib.sha256(request.path.encode() + b'\0' + request.get_data()).hexdigest()
+        client_key = request.headers.get('Idempotency-Key', '').strip()
+        if len(client_key) > IDEMPOTENCY_MAX_KEY:
+            return jsonify({'error': 'Idempotency-Key quá dài'}), 400
+        
+        scope = f"{current_tenant().id}:{request.path}"
+        if client_key:
+            key, ttl = f"{scope}:{client_key}", IDEMPOTENCY_TTL
+        else:
+            key, ttl = f"{scope}:auto:{fingerprint}", IDEMPOTENCY_AUTO_WINDOW
+        
+        # Request cùng khóa đang chạy (double-click): chờ kết quả của nó
+        deadline = time.time() + IDEMPOTENCY_WAIT
+        state, stored = idempotency_store.claim(key, fingerprint)
+        while state == 'pending' and time.time() < deadline:
+            time.sleep(0.2)
+            state, stored = idempotency_store.claim(key, fingerprint)
+        
+        if state == 'mismatch':
+            return jsonify({'error': 'Idempotency-Key đã được dùng cho dữ liệu khác'}), 422
+        if state == 'pending':
+            return jsonify({'error': 'Yêu cầu đang được xử lý, vui lòng thử lại sau'}), 409
+        if state == 'done':
+            status, body = stored
+            print(f"♻️ [IDEMPOTENCY] Trả lại kết quả đã lưu cho {request.path}")
+            response = Response(body, status=status, mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        
+        g.idempotent_result = None
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            if g.idempotent_result is None:
+                idempotency_store.release(key)
+                raise
+            print(f"⚠️ [IDEMPOTENCY] Lỗi sau khi đã ghi dữ liệu, trả kết quả thành công cho {request.path}")
+            response = jsonify(g.idempotent_result)
+        
+        if response.status_code >= 500 and g.idempotent_result is not None:
+            response = jsonify(g.idempotent_result)
+        if response.status_code >= 500:
+            idempotency_store.release(key)
+        else:
+            idempotency_store.complete(key, response.status_code, response.get_data(as_text=True), ttl)
+        return response
+    return wrapper
+
 # ==================== ROUTES CHÍNH ====================
 @app.route('/')
 def index():
@@ -233,20 +1954,74 @@ def report():
 def register():
     return render_template('register.html', version=APP_VERSION)
 
+@app.route('/display')
+def display():
+    return render_template('display.html', version=APP_VERSION)
+
 # ==================== API ENDPOINTS (OPTIMIZED) ====================
+CHECKIN_FIELDS = ('mssv', 'khoavien', 'phonghocnhom', 'soluong', 'nguoiNhap')
+BULK_MAX_ITEMS = 50
+
+def floor_of_room(phong_num):
+    """Vị trí tầng theo số phòng"""
+    if 1 <= phong_num <= 7:
+        return 'Lầu 3'
+    elif 8 <= phong_num <= 14:
+        return 'Lầu 4'
+    return 'Tầng trệt'
+
+def build_checkin_row(data, current_time):
+    """Dòng mới cho sheet Data (giờ ra = giờ vào + 90 phút)"""
+    mssv, khoavien, phonghocnhom, soluong, nguoi_nhap = (data.get(field, '') for field in CHECKIN_FIELDS)
+    floor_position = floor_of_room(int(phonghocnhom))
+    
+    return [
+        mssv, khoavien, phonghocnhom, soluong,
+        current_time.strftime("%H:%M:%S"),
+        (current_time + timedelta(minutes=90)).strftime("%H:%M:%S"),
+        current_time.strftime("%d/%m/%Y"), floor_position,
+        f"Tháng {current_time.month} năm {current_time.year}",
+        f"Phòng {phonghocnhom}", nguoi_nhap
+    ]
+
+def append_new_students(entries):
+    """Thêm vào LISTDS các sinh viên ([mssv, khoavien]) chưa có
+
+    Chỉ là bước phụ sau khi dòng chính đã ghi: lỗi ở đây được ghi log, không
+    làm request thất bại (client gửi lại sẽ ghi trùng dòng chính).
+    """
+    try:
+        known = get_students().keys
+        new_students = {}
+        for mssv, khoavien in entries:
+            clean_mssv = str(mssv).replace("'", "")
+            if clean_mssv not in known and clean_mssv not in new_students:
+                new_students[clean_mssv] = [mssv, khoavien]
+        if not new_students:
+            return
+        
+        sheet_listds = get_worksheet('LISTDS')
+        rows = list(new_students.values())
+        if len(rows) == 1:
+            sheets_call(sheet_listds.append_row, rows[0], idempotent=False)
+        else:
+            sheets_call(sheet_listds.append_rows, rows, idempotent=False)
+        invalidate_cache('LISTDS')
+        print(f"✅ Đã thêm {len(rows)} sinh viên mới vào LISTDS")
+    except Exception as e:
+        print(f"⚠️ [LISTDS] Không thêm được sinh viên mới: {e}")
+
 @app.route('/api/add_dulieusv', methods=['POST'])
+@idempotent_write
 def add_dulieusv():
     try:
         data = request.json
-        client = connect_to_sheets()
+        spreadsheet = open_spreadsheet()
         
-        if not client:
+        if not spreadsheet:
             return jsonify({'error': 'Không thể kết nối Google Sheets'}), 500
         
-        sheet_id = os.environ.get('SHEET_ID', '1i5N5Gdk-SqPN7Vy5IFiHiK5CTCw9WDag2EMZ1GBI8Wo')
-        spreadsheet = client.open_by_key(sheet_id)
-        sheet_data = spreadsheet.worksheet('Data')
-        sheet_listds = spreadsheet.worksheet('LISTDS')
+        sheet_data = get_worksheet('Data')
         
         mssv = data.get('mssv', '')
         khoavien = data.get('khoavien', '')
@@ -257,46 +2032,85 @@ def add_dulieusv():
         if not all([mssv, khoavien, phonghocnhom, soluong, nguoi_nhap]):
             return jsonify({'error': 'Vui lòng nhập đầy đủ thông tin!'}), 400
         
-        current_time = datetime.now()
-        check_in_time = current_time.strftime("%H:%M:%S")
-        check_out_time = (current_time + timedelta(minutes=90)).strftime("%H:%M:%S")
-        current_date = current_time.strftime("%d/%m/%Y")
-        
-        phong_num = int(phonghocnhom)
-        if 1 <= phong_num <= 7:
-            floor_position = 'Lầu 3'
-        elif 8 <= phong_num <= 14:
-            floor_position = 'Lầu 4'
-        else:
-            floor_position = 'Tầng trệt'
-        
-        new_row = [
-            mssv, khoavien, phonghocnhom, soluong, check_in_time,
-            check_out_time, current_date, floor_position,
-            f"Tháng {current_time.month} năm {current_time.year}",
-            f"Phòng {phonghocnhom}", nguoi_nhap
-        ]
+        try:
+            new_row = build_checkin_row(data, datetime.now())
+        except (TypeError, ValueError):  # phonghocnhom không phải số (kể cả list/object JSON)
+            return jsonify({'error': 'Số phòng không hợp lệ'}), 400
         
-        sheet_data.append_row(new_row)
+        sheets_call(sheet_data.append_row, new_row, idempotent=False)
+        result = {'message': 'Dữ liệu đã được thêm thành công'}
+        mark_written(result)
         
         # Xóa cache Data vì có dữ liệu mới
-        if 'Data' in data_cache:
-            del data_cache['Data']
-            print("🧹 [CACHE] Đã xóa cache Data do có dữ liệu mới")
+        invalidate_cache('Data')
+        print("🧹 [CACHE] Đã xóa cache Data do có dữ liệu mới")
         
-        listds_data = sheet_listds.get_all_values()
-        existing_mssvs = [row[0].replace("'", "") for row in listds_data[1:] if row]
+        append_new_students([(mssv, khoavien)])
         
-        clean_mssv = mssv.replace("'", "")
-        if clean_mssv not in existing_mssvs:
-            sheet_listds.append_row([mssv, khoavien])
-        
-        return jsonify({'message': 'Dữ liệu đã được thêm thành công'})
+        return jsonify(result)
         
+    except UpstreamUnavailable as e:
+        print(f"⛔ [add_dulieusv] {e}")
+        return jsonify({'error': 'Google Sheets đang quá tải, vui lòng thử lại sau'}), 503
     except Exception as e:
         print(f"Lỗi add_dulieusv: {e}")
         return jsonify({'error': f'Lỗi server: {str(e)}'}), 500
 
+@app.route('/api/add_dulieusv_bulk', methods=['POST'])
+@idempotent_write
+def add_dulieusv_bulk():
+    """Thêm nhiều lượt check-in trong một request: một append_rows cho Data và LISTDS
+
+    Body: {"items": [{mssv, khoavien, phonghocnhom, soluong, nguoiNhap}, ...]}.
+    Nếu có dòng không hợp lệ thì không ghi dòng nào.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        items = data.get('items')
+        
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'Danh sách check-in trống'}), 400
+        if len(items) > BULK_MAX_ITEMS:
+            return jsonify({'error': f'Tối đa {BULK_MAX_ITEMS} dòng mỗi lần'}), 400
+        
+        current_time = datetime.now()
+        new_rows = []
+        errors = []
+        for i, item in enumerate(items):
+            if not isinstance(item, dict) or not all(item.get(field) for field in CHECKIN_FIELDS):
+                errors.append({'index': i, 'error': 'Vui lòng nhập đầy đủ thông tin!'})
+                continue
+            try:
+                new_rows.append(build_checkin_row(item, current_time))
+            except (TypeError, ValueError):
+                errors.append({'index': i, 'error': 'Số phòng không hợp lệ'})
+        
+        if errors:
+            return jsonify({'error': 'Có dòng không hợp lệ, chưa ghi dữ liệu', 'errors': errors}), 400
+        
+        spreadsheet = open_spreadsheet()
+        if not spreadsheet:
+            return jsonify({'error': 'Không thể kết nối Google Sheets'}), 500
+        
+        sheet_data = get_worksheet('Data')
+        sheets_call(sheet_data.append_rows, new_rows, idempotent=False)
+        result = {'message': f'Đã thêm {len(new_rows)} lượt sử dụng', 'count': len(new_rows)}
+        mark_written(result)
+        invalidate_cache('Data')
+        print(f"🧹 [CACHE] Đã xóa cache Data do thêm {len(new_rows)} dòng")
+        
+        # Sinh viên mới (chưa có trong LISTDS, không lặp trong lô) ghi một lần
+        append_new_students([(item['mssv'], item['khoavien']) for item in items])
+        
+        return jsonify(result)
+        
+    except UpstreamUnavailable as e:
+        print(f"⛔ [add_dulieusv_bulk] {e}")
+        return jsonify({'error': 'Google Sheets đang quá tải, vui lòng thử lại sau'}), 503
+    except Exception as e:
+        print(f"Lỗi add_dulieusv_bulk: {e}")
+        return jsonify({'error': f'Lỗi server: {str(e)}'}), 500
+
 @app.route('/api/get_data')
 def get_data():
     try:
@@ -304,34 +2118,16 @@ def get_data():
         print("🔍 [get_data] Đang lấy dữ liệu (cached)...")
         
         # Sử dụng cache - 10 giây (giảm từ 30)
-        data = get_cached_data('Data', 10)
-        
-        if len(data) <= 1:
-            return jsonify([])
-            
-        formatted_data = []
-        for row in data[1:]:
-            if len(row) >= 7:
-                formatted_row = []
-                for col_idx, cell in enumerate(row[:7]):
-                    cell_value = str(cell) if cell is not None else ""
-                    
-                    # Xử lý cột ngày (G)
-                    if col_idx == 6:
-                        normalized = normalize_date(cell_value)
-                        formatted_row.append(normalized)
-                    # Xử lý cột giờ (E, F)
-                    elif col_idx in [4, 5]:
-                        if cell_value and ':' in cell_value:
-                            formatted_row.append(cell_value)
-                        else:
-                            formatted_row.append("")
-                    else:
-                        formatted_row.append(cell_value)
-                
-                formatted_data.append(formatted_row)
-        
-        result = formatted_data[::-1]  # Reverse order
+        checkins = get_checkins(10)
+        
+        # Mới nhất trước; cột giờ (E, F) không hợp lệ trả về rỗng, ngày (G) đã chuẩn hóa
+        result = [
+            [r.mssv, r.khoavien, r.phong, r.soluong,
+             r.check_in if ':' in r.check_in else "",
+             r.check_out if ':' in r.check_out else "",
+             r.date]
+            for r in reversed(checkins.records)
+        ]
         print(f"✅ [get_data] Trả về {len(result)} bản ghi")
         return jsonify(result)
         
@@ -346,16 +2142,8 @@ def get_data1():
         print("🔍 [get_data1] Đang lấy dữ liệu (cached)...")
         
         # Sử dụng cache - 10 giây (giảm từ 30)
-        data = get_cached_data('Data1', 10)
-        
-        if len(data) < 2:
-            return jsonify([])
-            
-        formatted_data = []
-        for row in data[1:]:
-            if len(row) >= 6:
-                formatted_row = [str(cell) if cell is not None else "" for cell in row[:6]]
-                formatted_data.append(formatted_row)
+        bookings = get_bookings(10)
+        formatted_data = [booking.as_row() for booking in bookings.records]
         
         print(f"✅ [get_data1] Trả về {len(formatted_data)} bản ghi")
         return jsonify(formatted_data)
@@ -370,21 +2158,11 @@ def get_data_count_today():
         print("🔍 [get_data_count_today] Đang tính thống kê hôm nay...")
         
         # Sử dụng cache để tránh request nhiều lần
-        data = get_cached_data('Data', 10)
+        checkins = get_checkins(10)
         
-        if len(data) <= 1:
-            return jsonify({"count": 0})
-            
-        today = datetime.now().strftime("%d/%m/%Y")
-        count = 0
-        
-        for row in data[1:]:
-            if len(row) >= 11:  # Đảm bảo có đủ cột đến K
-                date_cell = row[6]  # Cột G - Ngày
-                normalized_date = normalize_date(date_cell)
-                
-                if normalized_date == today:
-                    count += 1
+        # Chỉ xét phân vùng hôm nay, tính các dòng có đủ cột đến K
+        records = checkins.records
+        count = sum(1 for i in checkins.index.day(date.today().toordinal()) if records[i].complete)
         
         print(f"✅ [get_data_count_today] Kết quả: {count} lượt hôm nay")
         return jsonify({"count": count})
@@ -399,21 +2177,10 @@ def get_data1_count_today():
         print("🔍 [get_data1_count_today] Đang tính thống kê đăng ký hôm nay...")
         
         # Sử dụng cache
-        data = get_cached_data('Data1', 10)
+        bookings = get_bookings(10)
         
-        if len(data) <= 1:
-            return jsonify(0)
-            
         today = datetime.now().strftime("%d/%m/%Y")
-        count = 0
-        
-        for row in data[1:]:
-            if len(row) >= 6:
-                date_cell = row[5]  # Cột F - Ngày trong Data1
-                normalized_date = normalize_date(date_cell)
-                
-                if normalized_date == today:
-                    count += 1
+        count = sum(1 for b in bookings.records if b.date == today)
         
         print(f"✅ [get_data1_count_today] Kết quả: {count} lượt đăng ký hôm nay")
         return jsonify(count)
@@ -428,52 +2195,15 @@ def get_current_month_count_data():
         print("🔍 [get_current_month_count_data] Đang tính thống kê tháng...")
         
         # Sử dụng cache
-        data = get_cached_data('Data', 10)
+        checkins = get_checkins(10)
         
-        if len(data) <= 1:
-            return jsonify(0)
-            
         current_date = datetime.now()
         current_month = current_date.month
-        current_year = current_date.year
+        month_key = make_month_key(current_date.year, current_month)
         
-        count = 0
-        
-        for row in data[1:]:
-            if len(row) >= 11:
-                # Kiểm tra cả cột ngày (G) và cột tháng (I)
-                date_cell = row[6]  # Cột G - Ngày
-                month_cell = row[8]  # Cột I - Tháng
-                
-                # Ưu tiên kiểm tra cột tháng trước
-                if month_cell and "Tháng" in month_cell:
-                    try:
-                        parts = month_cell.split()
-                        if len(parts) >= 4:
-                            month_str = parts[1]
-                            year_str = parts[3]
-                            
-                            month_num = int(month_str)
-                            year_num = int(year_str)
-                            
-                            if month_num == current_month and year_num == current_year:
-                                count += 1
-                                continue
-                    except (ValueError, IndexError):
-                        pass
-                
-                # Nếu không có thông tin tháng, kiểm tra từ cột ngày
-                normalized_date = normalize_date(date_cell)
-                if normalized_date and '/' in normalized_date:
-                    try:
-                        day, month, year = normalized_date.split('/')
-                        month_num = int(month)
-                        year_num = int(year)
-                        
-                        if month_num == current_month and year_num == current_year:
-                            count += 1
-                    except (ValueError, IndexError):
-                        continue
+        # Khớp theo cột tháng (I) hoặc cột ngày (G)
+        records = checkins.records
+        count = sum(1 for i in checkins.index.any_month(month_key) if records[i].complete)
         
         print(f"✅ [get_current_month_count_data] Kết quả: {count} lượt tháng {current_month}")
         return jsonify(count)
@@ -482,30 +2212,23 @@ def get_current_month_count_data():
         print(f"❌ [get_current_month_count_data] Lỗi: {e}")
         return jsonify(0)
 
+ONLINE_ROWS = int(os.environ.get('ONLINE_ROWS', '20'))  # Giới hạn 20 dòng
+ONLINE_COLUMNS = [0, 1, 3]
+
 @app.route('/api/get_online_data')
 def get_online_data():
     try:
         rate_limit('get_online_data')
         print("🔍 [get_online_data] Đang lấy dữ liệu (cached)...")
         
-        # Sử dụng cache - 10 giây (giảm từ 15)
-        data = get_cached_data('Online', 10)
+        # Chỉ đọc header + ONLINE_ROWS dòng đầu của các cột A, B, D (cache 10 giây)
+        data = get_projection('Online', ONLINE_COLUMNS, 1, ONLINE_ROWS + 1, 10)
         
         if len(data) < 2:
             return jsonify({'headers': [], 'data': []})
 
         headers = data[0]
-        headers = [headers[i] for i in [0, 1, 3] if i < len(headers)]
-
-        result_data = []
-        for i in range(1, min(len(data), 21)):  # Giới hạn 20 dòng
-            row = data[i]
-            if len(row) >= 4:
-                result_data.append([
-                    row[0] if len(row) > 0 else '',
-                    row[1] if len(row) > 1 else '',
-                    row[3] if len(row) > 3 else ''
-                ])
+        result_data = data[1:]
 
         print(f"✅ [get_online_data] Trả về {len(result_data)} bản ghi")
         return jsonify({'headers': headers, 'data': result_data})
@@ -522,23 +2245,13 @@ def search_data():
             return jsonify([])
             
         rate_limit('search_data')
-        client = connect_to_sheets()
-        if not client:
-            return jsonify([])
-            
-        sheet_id = os.environ.get('SHEET_ID', '1i5N5Gdk-SqPN7Vy5IFiHiK5CTCw9WDag2EMZ1GBI8Wo')
-        spreadsheet = client.open_by_key(sheet_id)
-        sheet = spreadsheet.worksheet('LISTDS')
+        students = get_students()
         
-        data = sheet.get_all_values()
-        result = []
+        for student in students.records:
+            if student.khoavien is not None and keyword in student.mssv:
+                return jsonify([[student.mssv, student.khoavien]])
         
-        for row in data[1:]:
-            if len(row) >= 2 and keyword and keyword in str(row[0]):
-                result.append([row[0], row[1]])
-                break
-        
-        return jsonify(result)
+        return jsonify([])
         
     except Exception as e:
         print(f"Lỗi search_data: {e}")
@@ -547,19 +2260,8 @@ def search_data():
 @app.route('/api/get_nguoinhap_options')
 def get_nguoinhap_options():
     try:
-        rate_limit('get_nguoinhap_options')
-        client = connect_to_sheets()
-        if not client:
-            return jsonify([])
-            
-        sheet_id = os.environ.get('SHEET_ID', '1i5N5Gdk-SqPN7Vy5IFiHiK5CTCw9WDag2EMZ1GBI8Wo')
-        spreadsheet = client.open_by_key(sheet_id)
-        sheet = spreadsheet.worksheet('LISTDS')
-        
-        data = sheet.col_values(4)
-        if len(data) > 1:
-            return jsonify([item for item in data[1:21] if item])
-        return jsonify([])
+        # Danh sách người nhập lấy từ cache tham chiếu, không gọi Google Sheets mỗi lần tải trang
+        return jsonify(get_staff_roster())
         
     except Exception as e:
         print(f"Lỗi get_nguoinhap_options: {e}")
@@ -570,20 +2272,15 @@ def delete_data1():
     try:
         index = int(request.args.get('index', 0))
         rate_limit('delete_data1')
-        client = connect_to_sheets()
-        if not client:
+        sheet = get_worksheet('Data1')
+        if not sheet:
             return jsonify([])
-            
-        sheet_id = os.environ.get('SHEET_ID', '1i5N5Gdk-SqPN7Vy5IFiHiK5CTCw9WDag2EMZ1GBI8Wo')
-        spreadsheet = client.open_by_key(sheet_id)
-        sheet = spreadsheet.worksheet('Data1')
         
-        sheet.delete_rows(index + 2)
+        sheets_call(sheet.delete_rows, index + 2, idempotent=False)
         
         # Xóa cache Data1
-        if 'Data1' in data_cache:
-            del data_cache['Data1']
-            print("🧹 [CACHE] Đã xóa cache Data1 do xóa dữ liệu")
+        invalidate_cache('Data1')
+        print("🧹 [CACHE] Đã xóa cache Data1 do xóa dữ liệu")
             
         return get_data1()
         
@@ -595,16 +2292,21 @@ def delete_data1():
 @app.route('/api/debug_cache')
 def debug_cache():
     """Xem trạng thái cache"""
+    tenant = current_tenant()
     cache_info = {}
     current_time = time.time()
     
-    for sheet_name in data_cache:
-        if sheet_name in cache_timestamp:
-            age = current_time - cache_timestamp[sheet_name]
+    for cache_key, data in data_cache.items():
+        tenant_id, sheet_name = split_tenant_key(cache_key)
+        if tenant_id != tenant.id:
+            continue
+        if cache_key in cache_timestamp:
+            age = current_time - cache_timestamp[cache_key]
             cache_info[sheet_name] = {
                 'cached': True,
                 'age_seconds': round(age, 1),
-                'rows': len(data_cache[sheet_name])
+                'rows': data.row_count + 1 if isinstance(data, SheetTable) else len(data),
+                'generation': snapshot_generation.get(cache_key)
             }
         else:
             cache_info[sheet_name] = {
@@ -614,14 +2316,29 @@ def debug_cache():
             }
     
     return jsonify({
+        'tenant': tenant.id,
         'cache_info': cache_info,
-        'total_cached_sheets': len(data_cache)
+        'total_cached_sheets': len(cache_info),
+        'reference_data': {
+            name: {'version': revision, 'age_seconds': round(current_time - loaded_at, 1)}
+            for (tenant_id, name), (_value, revision, loaded_at) in reference_cache.items()
+            if tenant_id == tenant.id
+        },
+        'upstream': {
+            'circuit': tenant.breaker.status(),
+            'quota_used_last_minute': tenant.quota.used(),
+            'quota_per_minute': tenant.quota.per_minute
+        },
+        'shared_snapshot': SNAPSHOT_DIR if SNAPSHOT_ENABLED else None,
+        'idempotency_keys': idempotency_store.count()
     })
 
 @app.route('/api/clear_cache')
 def clear_cache_endpoint():
     """API để xóa cache thủ công"""
     clear_cache()
+    clear_reference_cache()
+    reset_sheets_connection()
     return jsonify({'message': 'Cache đã được xóa'})
 
 @app.route('/api/test_connection')
@@ -630,19 +2347,16 @@ def test_connection():
     try:
         rate_limit('test_connection')
         print("=== TEST CONNECTION ===")
-        client = connect_to_sheets()
-        if not client:
+        spreadsheet = open_spreadsheet()
+        if not spreadsheet:
             return jsonify({'status': 'error', 'message': 'No connection'})
         
-        sheet_id = os.environ.get('SHEET_ID', '1i5N5Gdk-SqPN7Vy5IFiHiK5CTCw9WDag2EMZ1GBI8Wo')
-        spreadsheet = client.open_by_key(sheet_id)
-        
         # Test các sheet tồn tại
         sheets_info = []
         for sheet_name in ['Data', 'Data1', 'LISTDS', 'Online']:
             try:
-                sheet = spreadsheet.worksheet(sheet_name)
-                row_count = len(sheet.get_all_values())
+                sheet = get_worksheet(sheet_name)
+                row_count = len(sheets_call(sheet.get_all_values))
                 sheets_info.append({
                     'name': sheet_name,
                     'rows': row_count,
@@ -674,52 +2388,27 @@ def quick_stats():
         results = {}
         
         # Lấy tất cả dữ liệu một lần
-        data = get_cached_data('Data', 10)  # Giảm cache time
-        data1 = get_cached_data('Data1', 10)  # Giảm cache time
+        checkins = get_checkins(10)  # Giảm cache time
+        bookings = get_bookings(10)  # Giảm cache time
         
         today = datetime.now().strftime("%d/%m/%Y")
-        current_month = datetime.now().month
-        current_year = datetime.now().year
+        month_key = make_month_key(datetime.now().year, datetime.now().month)
         
         # Thống kê Data
-        data_count_today = 0
-        month_count = 0
-        
-        if len(data) > 1:
-            for row in data[1:]:
-                if len(row) >= 7:
-                    date_cell = row[6]
-                    normalized_date = normalize_date(date_cell)
-                    
-                    if normalized_date == today:
-                        data_count_today += 1
-                    
-                    if normalized_date and '/' in normalized_date:
-                        try:
-                            day, month, year = normalized_date.split('/')
-                            if int(month) == current_month and int(year) == current_year:
-                                month_count += 1
-                        except (ValueError, IndexError):
-                            continue
+        data_count_today = len(checkins.index.day(date.today().toordinal()))
+        month_count = len(checkins.index.month(month_key))
         
         # Thống kê Data1
-        data1_count_today = 0
-        if len(data1) > 1:
-            for row in data1[1:]:
-                if len(row) >= 6:
-                    date_cell = row[5]
-                    normalized_date = normalize_date(date_cell)
-                    if normalized_date == today:
-                        data1_count_today += 1
+        data1_count_today = sum(1 for b in bookings.records if b.date == today)
         
         results = {
             'data_count_today': data_count_today,
             'data1_count_today': data1_count_today,
             'current_month_count': month_count,
-            'total_data_records': len(data) - 1,
-            'total_data1_records': len(data1) - 1,
+            'total_data_records': checkins.row_count,
+            'total_data1_records': bookings.row_count,
             'today': today,
-            'cache_status': 'using_cache'
+            'cache_status': 'stale' if g.get('stale_sheets') else 'using_cache'
         }
         
         print(f"✅ [quick_stats] Thống kê hoàn tất")
@@ -735,42 +2424,22 @@ def get_all_stats():
     try:
         rate_limit('get_all_stats')
         # Sử dụng cache với thời gian ngắn hơn
-        data = get_cached_data('Data', 10)  # Giảm từ 30 xuống 10
-        data1 = get_cached_data('Data1', 10)  # Giảm từ 30 xuống 10
+        checkins = get_checkins(10)  # Giảm từ 30 xuống 10
+        bookings = get_bookings(10)  # Giảm từ 30 xuống 10
 
         today = datetime.now().strftime("%d/%m/%Y")
-        current_month = datetime.now().month
-        current_year = datetime.now().year
-
-        today_usage = 0
-        month_usage = 0
-        today_register = 0
+        month_key = make_month_key(datetime.now().year, datetime.now().month)
 
         # Data (lịch sử)
-        if len(data) > 1:
-            for row in data[1:]:
-                if len(row) >= 7:
-                    normalized = normalize_date(row[6])
-                    if normalized == today:
-                        today_usage += 1
-                    if normalized and '/' in normalized:
-                        try:
-                            _, m, y = normalized.split('/')
-                            if int(m) == current_month and int(y) == current_year:
-                                month_usage += 1
-                        except Exception:
-                            continue
+        today_usage = len(checkins.index.day(date.today().toordinal()))
+        month_usage = len(checkins.index.month(month_key))
 
         # Data1 (đăng ký)
-        if len(data1) > 1:
-            for row in data1[1:]:
-                if len(row) >= 6:
-                    normalized = normalize_date(row[5])
-                    if normalized == today:
-                        today_register += 1
+        today_register = sum(1 for b in bookings.records if b.date == today)
 
         return jsonify({
             'success': True,
+            'stale': bool(g.get('stale_sheets')),
             'data': {
                 'today_usage': today_usage,
                 'month_usage': month_usage,
@@ -793,101 +2462,29 @@ def get_report_data():
         print(f"📊 [REPORT] Đang xử lý báo cáo: staff={staff_code}, location={location}, from={start_date_str}, to={end_date_str}")
         
         # Lấy dữ liệu từ cache
-        sheet_data = get_cached_data('Data', 10)
+        checkins = get_checkins(10)
         
-        if len(sheet_data) <= 1:
+        if checkins.row_count == 0:
             return jsonify([])
         
-        # Danh sách khoa viện
-        departments = [
-            'Khoa Công nghệ Cơ khí',
-            'Khoa Công nghệ Thông tin',
-            'Khoa Công nghệ Điện',
-            'Khoa Công nghệ Điện tử',
-            'Khoa Công nghệ Động lực',
-            'Khoa Công nghệ Nhiệt - Lạnh',
-            'Khoa Công nghệ May - Thời trang',
-            'Khoa Công nghệ Hóa học',
-            'Khoa Ngoại ngữ',
-            'Khoa Quản trị Kinh doanh',
-            'Khoa Thương mại - Du lịch',
-            'Khoa Kỹ thuật Xây dựng',
-            'Khoa Luật',
-            'Viện Tài chính - Kế toán',
-            'Viện Công nghệ Sinh học và Thực phẩm',
-            'Viện Khoa học Công nghệ và Quản lý Môi trường',
-            'Khoa Khoa học Cơ bản'
-        ]
-        
-        # Khởi tạo kết quả
-        result = {}
-        for dept in departments:
-            result[dept] = {'count': 0, 'sum': 0}
-        
         # Xử lý ngày tháng
         try:
-            if start_date_str:
-                start_date = datetime.strptime(start_date_str, '%Y-%m-%d')
-            else:
-                start_date = None
-                
-            if end_date_str:
-                end_date = datetime.strptime(end_date_str, '%Y-%m-%d')
-            else:
-                end_date = None
+            start_ord, end_ord = parse_report_dates(start_date_str, end_date_str)
         except ValueError as e:
             print(f"❌ [REPORT] Lỗi định dạng ngày: {e}")
             return jsonify([])
         
-        # Xử lý từng dòng dữ liệu
-        for row in sheet_data[1:]:  # Bỏ qua header
-            if len(row) < 11:  # Đảm bảo có đủ cột
-                continue
-                
-            # Lấy thông tin từ các cột
-            department = row[1] if len(row) > 1 else ''  # Cột B: Khoa viện
-            quantity_str = row[3] if len(row) > 3 else '0'  # Cột D: Số lượng
-            date_str = row[6] if len(row) > 6 else ''  # Cột G: Ngày
-            row_location = row[7] if len(row) > 7 else ''  # Cột H: Vị trí
-            staff_id = row[10] if len(row) > 10 else ''  # Cột K: Người nhập
-            
-            # Kiểm tra điều kiện lọc
-            valid_staff = not staff_code or staff_id == staff_code
-            valid_location = not location or row_location == location
-            
-            # Kiểm tra ngày
-            valid_date = True
-            if start_date or end_date:
-                try:
-                    row_date = normalize_date(date_str)
-                    if '/' in row_date:
-                        day, month, year = row_date.split('/')
-                        row_date_obj = datetime(int(year), int(month), int(day))
-                        
-                        if start_date and row_date_obj < start_date:
-                            valid_date = False
-                        if end_date and row_date_obj > end_date:
-                            valid_date = False
-                except Exception as e:
-                    valid_date = False
-            
-            # Nếu thỏa mãn tất cả điều kiện
-            if valid_staff and valid_location and valid_date and department in result:
-                try:
-                    quantity = int(float(quantity_str)) if quantity_str else 0
-                except ValueError:
-                    quantity = 0
-                
-                result[department]['count'] += 1
-                result[department]['sum'] += quantity
+        # Truy vấn bảng tổng hợp thay vì quét từng dòng
+        totals = report_totals(checkins, start_ord, end_ord, staff_code, location)
         
         # Chuyển đổi kết quả thành danh sách
         processed_data = []
-        for dept in departments:
+        for dept in get_departments():
+            count, total = totals.get(dept, (0, 0))
             processed_data.append({
                 'faculty': dept,
-                'count': result[dept]['count'],
-                'sum': result[dept]['sum']
+                'count': count,
+                'sum': total
             })
         
         print(f"✅ [REPORT] Trả về {len(processed_data)} khoa viện")
@@ -899,20 +2496,273 @@ def get_report_data():
         traceback.print_exc()
         return jsonify([])
     
+@app.route('/api/usage-statistics', methods=['GET', 'POST'])
+def usage_statistics():
+    """Số lượt sử dụng theo khoa viện, giảm dần (trước đây nằm trong server.js)"""
+    try:
+        if request.method == 'POST':
+            params = request.get_json(silent=True) or {}
+        else:
+            params = request.args
+        staff_code = params.get('staffCode', '')
+        location = params.get('location', '')
+        
+        try:
+            start_ord, end_ord = parse_report_dates(params.get('startDate', ''), params.get('endDate', ''))
+        except ValueError:
+            return jsonify({'error': 'Định dạng ngày không hợp lệ (YYYY-MM-DD)'}), 400
+        
+        totals = report_totals(get_checkins(10), start_ord, end_ord, staff_code, location)
+        result = [
+            {'faculty': faculty, 'usageCount': count}
+            for faculty, (count, _total) in totals.items() if count
+        ]
+        result.sort(key=lambda item: item['usageCount'], reverse=True)
+        return jsonify(result)
+        
+    except Exception as e:
+        print(f"❌ [usage-statistics] Lỗi: {e}")
+        return jsonify({'error': str(e)}), 500
+
+# ==================== PHÒNG QUÁ GIỜ / SẮP HẾT GIỜ ====================
+# Luồng nền giữ danh sách nhóm đang dùng mỗi phòng (lượt vào gần nhất) sắp xếp
+# theo giờ ra, tính từ cột phút đã parse sẵn trong CheckIn. Danh sách chỉ được sắp
+# lại khi bảng Data đổi; /api/overdue chỉ bisect trên danh sách đó.
+OVERDUE_REFRESH = int(os.environ.get('OVERDUE_REFRESH', '30'))
+OVERDUE_WINDOW = 120  # Quá giờ ra lâu hơn thì coi như nhóm đã rời phòng
+EXPIRING_WINDOW = 15  # Phút trước giờ ra được xem là sắp hết giờ
+MINUTES_PER_DAY = 24 * 60
+
+def minute_stamp(moment):
+    """Số phút tuyệt đối (theo ordinal ngày) để so sánh qua nửa đêm"""
+    return moment.toordinal() * MINUTES_PER_DAY + moment.hour * 60 + moment.minute
+
+def format_minute(stamp):
+    hour, minute = divmod(stamp % MINUTES_PER_DAY, 60)
+    return f"{hour:02d}:{minute:02d}"
+
+class OverdueTracker:
+    """Danh sách (giờ ra, phòng, giờ vào, lượt sử dụng) của hôm qua và hôm nay, tăng dần theo giờ ra"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = []  # Thay mới (không sửa tại chỗ) để status() đọc không cần copy
+        self.ends = []  # Giờ ra của entries, để bisect
+        self.source = None
+        self.built_day = None
+        self.updated_at = 0
+
+    def _rebuild(self, checkins, today):
+        occupants = {}
+        for day_key in (today - 1, today):
+            for position in checkins.index.day(day_key):
+                checkin = checkins.records[position]
+                if checkin.in_minute is None or checkin.out_minute is None:
+                    continue
+                start = day_key * MINUTES_PER_DAY + checkin.in_minute
+                end = day_key * MINUTES_PER_DAY + checkin.out_minute
+                if end < start:
+                    end += MINUTES_PER_DAY  # Giờ ra qua nửa đêm
+                
+                current = occupants.get(checkin.phong)
+                if current is None or start >= current[2]:
+                    occupants[checkin.phong] = (end, checkin.phong, start, checkin)
+        
+        self.entries = sorted(occupants.values())
+        self.ends = [entry[0] for entry in self.entries]
+        self.source = checkins
+        self.built_day = today
+
+    def refresh(self):
+        checkins = get_checkins(OVERDUE_REFRESH)
+        now = datetime.now()
+        with self.lock:
+            if checkins is not self.source or self.built_day != now.toordinal():
+                self._rebuild(checkins, now.toordinal())
+            
+            # Bỏ các nhóm đã quá giờ ra quá lâu
+            expired = bisect.bisect_left(self.ends, minute_stamp(now) - OVERDUE_WINDOW)
+            if expired:
+                self.entries = self.entries[expired:]
+                self.ends = self.ends[expired:]
+            self.updated_at = time.time()
+
+    def status(self, expiring_window=EXPIRING_WINDOW):
+        if time.time() - self.updated_at > OVERDUE_REFRESH:
+            self.refresh()
+        
+        now_stamp = minute_stamp(datetime.now())
+        with self.lock:
+            entries, ends, updated_at = self.entries, self.ends, self.updated_at
+        
+        overdue, expiring = [], []
+        for index in range(bisect.bisect_right(ends, now_stamp + expiring_window)):
+            end, room, start, checkin = entries[index]
+            item = {
+                'room': room,
+                'mssv': checkin.mssv,
+                'khoavien': checkin.khoavien,
+                'soluong': checkin.soluong,
+                'check_in': format_minute(start),
+                'check_out': format_minute(end)
+            }
+            if end <= now_stamp:
+                item['minutes_over'] = now_stamp - end
+                overdue.append(item)
+            elif start <= now_stamp:
+                item['minutes_left'] = end - now_stamp
+                expiring.append(item)
+        
+        next_checkout = next((
+            end for end, _room, start, _checkin in islice(entries, bisect.bisect_right(ends, now_stamp), None)
+            if start <= now_stamp
+        ), None)
+        return {
+            'overdue': overdue,
+            'expiring': expiring,
+            'next_checkout': format_minute(next_checkout) if next_checkout is not None else None,
+            'updated_at': datetime.fromtimestamp(updated_at).isoformat(timespec='seconds')
+        }
+
+overdue_trackers = {}  # tenant -> OverdueTracker
+overdue_trackers_lock = threading.Lock()
+
+def get_overdue_tracker():
+    tenant_id = current_tenant().id
+    with overdue_trackers_lock:
+        if tenant_id not in overdue_trackers:
+            overdue_trackers[tenant_id] = OverdueTracker()
+        return overdue_trackers[tenant_id]
+
+def overdue_job():
+    while True:
+        for tenant in list(tenants.values()):
+            try:
+                with use_tenant(tenant):
+                    get_overdue_tracker().refresh()
+            except Exception as e:
+                print(f"⚠️ [OVERDUE] Lỗi cập nhật ({tenant.id}): {e}")
+        time.sleep(OVERDUE_REFRESH)
+
+@app.route('/api/overdue')
+def get_overdue():
+    """Phòng đã quá giờ ra và phòng sắp hết giờ (trong ?within= phút, mặc định 15)"""
+    try:
+        try:
+            within = max(0, min(int(request.args.get('within', EXPIRING_WINDOW)), 180))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'within phải là số phút'}), 400
+        
+        return jsonify({'success': True, **get_overdue_tracker().status(within)})
+        
+    except Exception as e:
+        print(f"❌ [overdue] Lỗi: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# ==================== XUẤT DỮ LIỆU ====================
+# Ghi từng phần ra response thay vì dựng cả danh sách/JSON trong bộ nhớ
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_COLUMNS = 11  # Cột A..K của sheet Data
+
+def iter_export_rows(checkins, start_ord, end_ord, staff_code, location):
+    """Các dòng Data (A..K) thỏa bộ lọc báo cáo, theo thứ tự trên sheet"""
+    records = checkins.records
+    if start_ord is None and end_ord is None:
+        candidates = records
+    else:
+        # Chỉ các phân vùng ngày trong khoảng lọc (và dòng không có ngày)
+        positions = checkins.index.day_range(start_ord, end_ord) + list(checkins.index.undated)
+        candidates = (records[i] for i in sorted(positions))
+    
+    for checkin in candidates:
+        if report_row_matches(checkin, start_ord, end_ord, staff_code, location):
+            yield checkin.as_row()
+
+def stream_csv(header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')  # BOM để Excel hiển thị đúng tiếng Việt
+    writer.writerow(header)
+    
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    
+    yield buffer.getvalue()
+
+def stream_xlsx(header, rows):
+    """Ghi XLSX ở chế độ write_only ra file tạm rồi đọc ra từng phần"""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet('Data')
+    worksheet.append(header)
+    for row in rows:
+        worksheet.append(row)
+    
+    with tempfile.TemporaryFile() as f:
+        workbook.save(f)
+        f.seek(0)
+        while True:
+            chunk = f.read(EXPORT_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+@app.route('/api/export')
+def export_data():
+    """Xuất lịch sử Data dạng CSV (mặc định) hoặc XLSX, cùng bộ lọc với báo cáo"""
+    export_format = request.args.get('format', 'csv').lower()
+    staff_code = request.args.get('staffCode', '')
+    location = request.args.get('location', '')
+    start_date_str = request.args.get('startDate', '')
+    end_date_str = request.args.get('endDate', '')
+    
+    if export_format not in ('csv', 'xlsx'):
+        return jsonify({'error': 'Định dạng không hỗ trợ (csv hoặc xlsx)'}), 400
+    
+    try:
+        start_ord, end_ord = parse_report_dates(start_date_str, end_date_str)
+    except ValueError:
+        return jsonify({'error': 'Định dạng ngày không hợp lệ (YYYY-MM-DD)'}), 400
+    
+    if export_format == 'xlsx':
+        try:
+            import openpyxl  # noqa: F401
+        except ImportError:
+            return jsonify({'error': 'Máy chủ chưa cài openpyxl để xuất XLSX'}), 501
+    
+    print(f"📤 [EXPORT] {export_format}: staff={staff_code}, location={location}, from={start_date_str}, to={end_date_str}")
+    checkins = get_checkins(10)
+    header = checkins.header[:EXPORT_COLUMNS]
+    rows = iter_export_rows(checkins, start_ord, end_ord, staff_code, location)
+    
+    filename = f"lich-su-phong-hoc-{start_date_str or 'all'}-to-{end_date_str or 'all'}.{export_format}"
+    if export_format == 'xlsx':
+        body = stream_xlsx(header, rows)
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    else:
+        body = stream_csv(header, rows)
+        mimetype = 'text/csv; charset=utf-8'
+    
+    return Response(body, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
 # ==================== API ĐĂNG KÝ PHÒNG ====================
 @app.route('/api/register_room', methods=['POST'])
+@idempotent_write
 def register_room():
     try:
         data = request.json
-        client = connect_to_sheets()
+        spreadsheet = open_spreadsheet()
         
-        if not client:
+        if not spreadsheet:
             return jsonify({'error': 'Không thể kết nối Google Sheets'}), 500
         
-        sheet_id = os.environ.get('SHEET_ID', '1i5N5Gdk-SqPN7Vy5IFiHiK5CTCw9WDag2EMZ1GBI8Wo')
-        spreadsheet = client.open_by_key(sheet_id)
-        sheet_data1 = spreadsheet.worksheet('Data1')
-        sheet_listds = spreadsheet.worksheet('LISTDS')
+        sheet_data1 = get_worksheet('Data1')
         
         mssv = data.get('mssv', '')
         khoavien = data.get('khoavien', '')
@@ -935,13 +2785,7 @@ def register_room():
         
         # Xác định vị trí tầng dựa trên số phòng
         try:
-            phong_num = int(phonghocnhom)
-            if 1 <= phong_num <= 7:
-                floor_position = 'Lầu 3'
-            elif 8 <= phong_num <= 14:
-                floor_position = 'Lầu 4'
-            else:
-                floor_position = 'Tầng trệt'
+            floor_position = floor_of_room(int(phonghocnhom))
         except ValueError:
             floor_position = 'Không xác định'
         
@@ -956,39 +2800,166 @@ def register_room():
             floor_position   # Vị trí tầng
         ]
         
-        sheet_data1.append_row(new_row)
+        sheets_call(sheet_data1.append_row, new_row, idempotent=False)
+        result = {'message': 'Đăng ký phòng học nhóm thành công!'}
+        mark_written(result)
         
         # Xóa cache Data1 vì có dữ liệu mới
-        if 'Data1' in data_cache:
-            del data_cache['Data1']
-            print("🧹 [CACHE] Đã xóa cache Data1 do có đăng ký mới")
+        invalidate_cache('Data1')
+        print("🧹 [CACHE] Đã xóa cache Data1 do có đăng ký mới")
         
         # Kiểm tra và thêm vào LISTDS nếu chưa có
-        listds_data = sheet_listds.get_all_values()
-        existing_mssvs = [row[0].replace("'", "") for row in listds_data[1:] if row]
-        
-        clean_mssv = mssv.replace("'", "")
-        if clean_mssv not in existing_mssvs:
-            sheet_listds.append_row([mssv, khoavien])
-            print(f"✅ Đã thêm sinh viên mới vào LISTDS: {clean_mssv}")
+        append_new_students([(mssv, khoavien)])
         
-        return jsonify({'message': 'Đăng ký phòng học nhóm thành công!'})
+        return jsonify(result)
         
+    except UpstreamUnavailable as e:
+        print(f"⛔ [register_room] {e}")
+        return jsonify({'error': 'Google Sheets đang quá tải, vui lòng thử lại sau'}), 503
     except Exception as e:
         print(f"❌ Lỗi register_room: {e}")
         import traceback
         traceback.print_exc()
         return jsonify({'error': f'Lỗi server: {str(e)}'}), 500
-                            
-if __name__ == '__main__':
-    print("Đang khởi động ứng dụng...")
+
+
+# ==================== STARTUP & HEALTH CHECK ====================
+# Ứng dụng nhận request ngay; kết nối Google Sheets và cache được làm nóng ở
+# luồng nền. /healthz cho biết tiến trình còn sống, /readyz cho biết đã sẵn sàng.
+# Luồng nền được bật ở request đầu tiên của mỗi worker (không bật lúc import) để
+# gunicorn --preload không fork mất luồng của tiến trình master.
+# Tiến trình sẵn sàng khi tenant mặc định đã nạp xong; tenant khác lỗi chỉ được
+# báo riêng trong /readyz và tiếp tục thử lại ở nền.
+STARTUP_WARMUP = os.environ.get('STARTUP_WARMUP', '1') != '0'
+WARMUP_SHEETS = ('Data', 'Data1')
+IMPORT_TIME_BUDGET_MS = float(os.environ.get('IMPORT_TIME_BUDGET_MS', '500'))
+WARMUP_MAX_AGE = 60  # Dữ liệu cũ hơn (snapshot cũ, bản stale) không tính là đã nạp
+startup_state = {
+    'started_at': time.time(),
+    'warmup_started': False,
+    'ready': not STARTUP_WARMUP,
+    'tenants': {}  # tenant -> {'ready', 'error'}
+}
+
+def load_for_warmup(sheet_name):
+    """Nạp sheet vào cache; True chỉ khi lấy được dữ liệu mới (không phải bản rỗng / stale)"""
+    get_cached_data(sheet_name, 10)
+    fetched_at = cache_timestamp.get(tenant_key(sheet_name))
+    return fetched_at is not None and time.time() - fetched_at < WARMUP_MAX_AGE
+
+def warm_up_tenant(tenant):
+    """Nạp cache cho một tenant, trả về thông báo lỗi hoặc None nếu đã sẵn sàng"""
     try:
-        client = connect_to_sheets()
-        if client:
-            print("✅ Kết nối Google Sheets thành công!")
-        else:
-            print("❌ Không thể kết nối Google Sheets")
+        with use_tenant(tenant):
+            if not open_spreadsheet():
+                return 'Không thể kết nối Google Sheets'
+            if not all([load_for_warmup(sheet_name) for sheet_name in WARMUP_SHEETS]):
+                return 'Chưa nạp được dữ liệu'
     except Exception as e:
-        print(f"❌ Lỗi kết nối: {e}")
+        print(f"❌ [WARMUP] Lỗi ({tenant.id}): {e}")
+        return str(e)
+    return None
+
+def warm_up():
+    """Kết nối Google Sheets và nạp cache cho mọi tenant, thử lại với thời gian chờ tăng dần"""
+    delay = 2
+    pending = list(tenants.values())
+    while True:
+        for tenant in list(pending):
+            error = warm_up_tenant(tenant)
+            startup_state['tenants'][tenant.id] = {'ready': error is None, 'error': error}
+            if error is None:
+                pending.remove(tenant)
+                print(f"✅ [WARMUP] Tenant {tenant.id} đã sẵn sàng")
+                if tenant.id == DEFAULT_TENANT:
+                    startup_state['ready'] = True
+        
+        if not pending:
+            print("✅ [WARMUP] Đã sẵn sàng phục vụ")
+            return
+        
+        time.sleep(delay)
+        delay = min(delay * 2, 60)
+
+def start_background_warmup():
+    if not STARTUP_WARMUP or startup_state['warmup_started']:
+        return
+    startup_state['warmup_started'] = True
+    threading.Thread(target=warm_up, name='sheets-warmup', daemon=True).start()
+    threading.Thread(target=overdue_job, name='overdue-tracker', daemon=True).start()
+
+def reset_startup_state():
+    """Tiến trình con sau fork không có luồng nền của tiến trình cha"""
+    startup_state['warmup_started'] = False
+    startup_state['ready'] = not STARTUP_WARMUP
+    startup_state['tenants'] = {}
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_startup_state)
+
+@app.before_request
+def ensure_warmup():
+    if not startup_state['warmup_started']:
+        start_background_warmup()
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: tiến trình còn phản hồi"""
+    return jsonify({
+        'status': 'ok',
+        'version': APP_VERSION,
+        'uptime_seconds': round(time.time() - startup_state['started_at'], 1),
+        'import_ms': round(IMPORT_DURATION_MS, 1),
+        'tenants': sorted(tenants)
+    })
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: tenant mặc định đã kết nối Google Sheets và nạp cache; kèm trạng thái từng tenant"""
+    tenant_status = {}
+    for tenant_id, tenant in tenants.items():
+        state = startup_state['tenants'].get(tenant_id, {'ready': not STARTUP_WARMUP, 'error': None})
+        tenant_status[tenant_id] = dict(state, connected=tenant.spreadsheet is not None)
+    body = {
+        'ready': startup_state['ready'],
+        'tenants': tenant_status
+    }
+    return jsonify(body), 200 if startup_state['ready'] else 503
+
+def run_startup_benchmark(runs=5):
+    """Đo thời gian import main.py trong tiến trình mới và so với ngân sách"""
+    code = (
+        "import sys, time; started = time.perf_counter(); import main; "
+        "print((time.perf_counter() - started) * 1000, 'gspread' in sys.modules)"
+    )
+    env = dict(os.environ, STARTUP_WARMUP='0')
+    app_dir = os.path.dirname(os.path.abspath(__file__))
     
-    app.run(host='0.0.0.0', port=8000, debug=True)
\ No newline at end of file
+    timings = []
+    eager_google = False
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', code], cwd=app_dir, env=env,
+                                capture_output=True, text=True, check=True)
+        elapsed_ms, google_loaded = result.stdout.strip().splitlines()[-1].split()
+        timings.append(float(elapsed_ms))
+        eager_google = eager_google or google_loaded == 'True'
+    
+    timings.sort()
+    median_ms = timings[len(timings) // 2]
+    print(f"⏱️ [STARTUP] import main: median {median_ms:.1f}ms, min {timings[0]:.1f}ms "
+          f"(ngân sách {IMPORT_TIME_BUDGET_MS:.0f}ms, {runs} lần)")
+    if eager_google:
+        print("❌ [STARTUP] gspread bị import ngay khi khởi động")
+    
+    return 0 if median_ms <= IMPORT_TIME_BUDGET_MS and not eager_google else 1
+
+IMPORT_DURATION_MS = (time.perf_counter() - IMPORT_STARTED) * 1000
+if IMPORT_DURATION_MS > IMPORT_TIME_BUDGET_MS:
+    print(f"⚠️ [STARTUP] Import mất {IMPORT_DURATION_MS:.0f}ms, vượt ngân sách {IMPORT_TIME_BUDGET_MS:.0f}ms")
+
+if __name__ == '__main__':
+    if '--startup-benchmark' in sys.argv:
+        sys.exit(run_startup_benchmark())
+    
+    print("Đang khởi động ứng dụng...")
+    app.run(host='0.0.0.0', port=8000, debug=True)
@@ -1,83 +0,0 @@
-// API để lấy thống kê sử dụng
-app.post('/api/usage-statistics', (req, res) => {
-    const { staffCode, location, startDate, endDate } = req.body;
-    
-    let query = `
-        SELECT 
-            faculty,
-            COUNT(*) as usageCount
-        FROM study_room_usage 
-        WHERE 1=1
-    `;
-    
-    const params = [];
-    
-    // Thêm điều kiện lọc theo mã nhân sự
-    if (staffCode) {
-        query += ' AND staff_id = ?';
-        params.push(staffCode);
-    }
-    
-    // Thêm điều kiện lọc theo vị trí (lầu/tầng)
-    if (location) {
-        if (location === 'Tầng trệt') {
-            query += ' AND (room LIKE "%trệt%" OR room LIKE "%1%" OR room LIKE "%Tầng 1%" OR room = "1")';
-        } else if (location === 'Lầu 3') {
-            query += ' AND (room LIKE "%3%" OR room LIKE "%Lầu 3%" OR room = "3")';
-        } else if (location === 'Lầu 4') {
-            query += ' AND (room LIKE "%4%" OR room LIKE "%Lầu 4%" OR room = "4")';
-        }
-    }
-    
-    // Thêm điều kiện lọc theo ngày
-    if (startDate) {
-        query += ' AND date >= ?';
-        params.push(startDate);
-    }
-    
-    if (endDate) {
-        query += ' AND date <= ?';
-        params.push(endDate);
-    }
-    
-    query += ' GROUP BY faculty ORDER BY usageCount DESC';
-    
-    db.all(query, params, (err, rows) => {
-        if (err) {
-            console.error('Lỗi khi lấy thống kê:', err);
-            // Trả về dữ liệu mẫu nếu có lỗi
-            const sampleData = [
-                { faculty: "Khoa Công nghệ Thông tin", usageCount: 147 },
-                { faculty: "Khoa Công nghệ Cơ khí", usageCount: 107 },
-                { faculty: "Khoa Công nghệ Điện", usageCount: 89 }
-            ];
-            res.json(sampleData);
-        } else {
-            // Nếu không có dữ liệu, trả về mẫu
-            if (rows.length === 0) {
-                const sampleData = [
-                    { faculty: "Khoa Công nghệ Thông tin", usageCount: 147 },
-                    { faculty: "Khoa Công nghệ Cơ khí", usageCount: 107 },
-                    { faculty: "Khoa Công nghệ Điện", usageCount: 89 },
-                    { faculty: "Khoa Quản trị Kinh doanh", usageCount: 76 },
-                    { faculty: "Khoa Ngoại ngữ", usageCount: 65 }
-                ];
-                res.json(sampleData);
-            } else {
-                res.json(rows);
-            }
-        }
-    });
-});
-
-// API fallback - GET method
-app.get('/api/usage-statistics', (req, res) => {
-    const sampleData = [
-        { faculty: "Khoa Công nghệ Thông tin", usageCount: 147 },
-        { faculty: "Khoa Công nghệ Cơ khí", usageCount: 107 },
-        { faculty: "Khoa Công nghệ Điện", usageCount: 89 },
-        { faculty: "Khoa Quản trị Kinh doanh", usageCount: 76 },
-        { faculty: "Khoa Ngoại ngữ", usageCount: 65 }
-    ];
-    res.json(sampleData);
-});
\ No newline at end of file
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# Không chạy warm-up nền; snapshot và bảng idempotency nằm trong thư mục tạm riêng
+os.environ.setdefault('STARTUP_WARMUP', '0')
+os.environ.setdefault('SNAPSHOT_DIR', tempfile.mkdtemp(prefix='phonghocnhom-test-'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,77 @@
+from datetime import date, timedelta
+
+import main
+
+HEADER = ['MSSV', 'Khoa', 'Phòng', 'SL', 'Giờ vào', 'Giờ ra', 'Ngày',
+          'Vị trí', 'Tháng', 'Phòng', 'Người nhập']
+
+
+def make_rows(count):
+    day = date.today() - timedelta(days=1)
+    rows = [HEADER]
+    for i in range(count):
+        rows.append([f'SV{i}', 'Khoa Luật', '3', str(i % 5 + 1), '08:00', '09:00',
+                     day.strftime('%d/%m/%Y'), 'Lầu 3', f'Tháng {day.month} năm {day.year}',
+                     'Phòng 3', 'NV0'])
+    return rows
+
+
+def make_table(count, fetched_at, rows=None):
+    table = main.parse_checkins(rows if rows is not None else make_rows(count))
+    table.fetched_at = fetched_at
+    return table
+
+
+def expected_totals(count):
+    return {'Khoa Luật': [count, sum(i % 5 + 1 for i in range(count))]}
+
+
+def test_shared_file_is_not_double_counted(tmp_path):
+    path = str(tmp_path / 'reports.db')
+    first, second = main.ReportEngine(path), main.ReportEngine(path)
+    old, new = make_table(10, 1.0), make_table(12, 2.0)
+
+    first.update(old)
+    second.update(old)
+    second.update(new)
+    first.update(new)
+
+    for engine in (first, second):
+        totals, partial_months = engine.query()
+        assert totals == expected_totals(12)
+        assert partial_months == []
+
+
+def test_stale_worker_does_not_roll_back_newer_ingest(tmp_path):
+    path = str(tmp_path / 'reports.db')
+    first, second = main.ReportEngine(path), main.ReportEngine(path)
+
+    second.update(make_table(12, 2.0))
+    first.update(make_table(10, 1.0))
+
+    assert first.query()[0] == expected_totals(12)
+
+
+def test_edited_row_triggers_rebuild(tmp_path):
+    path = str(tmp_path / 'reports.db')
+    first, second = main.ReportEngine(path), main.ReportEngine(path)
+    rows = make_rows(10)
+
+    first.update(make_table(10, 1.0, rows))
+    rows[-1][3] = '50'
+    second.update(make_table(11, 2.0, rows + make_rows(11)[11:]))
+
+    totals = first.query()[0]
+    assert totals['Khoa Luật'][0] == 11
+    assert totals['Khoa Luật'][1] == expected_totals(9)['Khoa Luật'][1] + 50 + 1
+
+
+def test_deleted_row_triggers_rebuild():
+    engine = main.ReportEngine(':memory:')
+    rows = make_rows(12)
+
+    engine.update(make_table(12, 1.0, rows))
+    del rows[5]
+    engine.update(make_table(11, 2.0, rows))
+
+    assert engine.query()[0] == {'Khoa Luật': [11, expected_totals(12)['Khoa Luật'][1] - 5]}
@@ -0,0 +1,143 @@
+import pytest
+
+import main
+
+DATA_HEADER = ['MSSV', 'Khoa', 'Phòng', 'SL', 'Giờ vào', 'Giờ ra', 'Ngày',
+               'Vị trí', 'Tháng', 'Phòng', 'Người nhập']
+CHECKIN = {'mssv': 'SV1', 'khoavien': 'Khoa Luật', 'phonghocnhom': '3',
+           'soluong': '2', 'nguoiNhap': 'NV0'}
+
+
+class FakeWorksheet:
+    def __init__(self, rows):
+        self.rows = rows
+        self.appends = 0
+        self.fail = None
+
+    def get_all_values(self):
+        return [list(row) for row in self.rows]
+
+    def append_row(self, row, **kwargs):
+        self.append_rows([row])
+
+    def append_rows(self, rows, **kwargs):
+        if self.fail:
+            raise self.fail
+        self.appends += 1
+        self.rows.extend(rows)
+
+
+class FakeSpreadsheet:
+    def __init__(self):
+        self.sheets = {
+            'Data': FakeWorksheet([DATA_HEADER]),
+            'LISTDS': FakeWorksheet([['MSSV', 'Khoa'], ['SV0', 'Khoa Luật']]),
+        }
+
+    def worksheet(self, name):
+        return self.sheets[name]
+
+
+class FakeClient:
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open_by_key(self, key):
+        return self.spreadsheet
+
+
+@pytest.fixture
+def sheets(monkeypatch):
+    spreadsheet = FakeSpreadsheet()
+    tenant = main.tenants[main.DEFAULT_TENANT]
+    monkeypatch.setattr(main, 'connect_to_sheets', lambda: FakeClient(spreadsheet))
+    monkeypatch.setattr(main, 'idempotency_store', main.IdempotencyStore(':memory:'))
+    monkeypatch.setattr(main, 'SNAPSHOT_ENABLED', False)
+    monkeypatch.setattr(tenant, 'spreadsheet', None)
+    monkeypatch.setattr(tenant, 'worksheets', {})
+    for cache in (main.data_cache, main.cache_timestamp, main.last_good_data):
+        cache.clear()
+    return spreadsheet.sheets
+
+
+@pytest.fixture
+def client(sheets):
+    return main.app.test_client()
+
+
+def data_rows(sheets):
+    return sheets['Data'].rows[1:]
+
+
+def test_same_key_is_replayed_without_writing_again(client, sheets):
+    headers = {'Idempotency-Key': 'k1'}
+    first = client.post('/api/add_dulieusv', json=CHECKIN, headers=headers)
+    second = client.post('/api/add_dulieusv', json=CHECKIN, headers=headers)
+
+    assert first.status_code == second.status_code == 200
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert second.get_json() == first.get_json()
+    assert len(data_rows(sheets)) == 1
+
+
+def test_same_key_with_other_body_is_rejected(client, sheets):
+    headers = {'Idempotency-Key': 'k1'}
+    client.post('/api/add_dulieusv', json=CHECKIN, headers=headers)
+    response = client.post('/api/add_dulieusv', json={**CHECKIN, 'soluong': '3'}, headers=headers)
+
+    assert response.status_code == 422
+    assert len(data_rows(sheets)) == 1
+
+
+def test_key_is_released_when_nothing_was_written(client, sheets):
+    headers = {'Idempotency-Key': 'k1'}
+    sheets['Data'].fail = RuntimeError('Data unavailable')
+    failed = client.post('/api/add_dulieusv', json=CHECKIN, headers=headers)
+    sheets['Data'].fail = None
+    retried = client.post('/api/add_dulieusv', json=CHECKIN, headers=headers)
+
+    assert failed.status_code == 500
+    assert retried.status_code == 200
+    assert 'Idempotent-Replayed' not in retried.headers
+    assert len(data_rows(sheets)) == 1
+
+
+def test_key_is_kept_once_data_was_written(client, sheets):
+    headers = {'Idempotency-Key': 'k1'}
+    sheets['LISTDS'].fail = RuntimeError('LISTDS unavailable')
+    first = client.post('/api/add_dulieusv', json=CHECKIN, headers=headers)
+    sheets['LISTDS'].fail = None
+    retried = client.post('/api/add_dulieusv', json=CHECKIN, headers=headers)
+
+    assert first.status_code == 200
+    assert retried.headers['Idempotent-Replayed'] == 'true'
+    assert len(data_rows(sheets)) == 1
+
+
+def test_bulk_writes_rows_and_new_students_once(client, sheets):
+    items = [CHECKIN, {**CHECKIN, 'mssv': 'SV0'}, {**CHECKIN, 'phonghocnhom': '9'}]
+    response = client.post('/api/add_dulieusv_bulk', json={'items': items})
+
+    assert response.status_code == 200
+    assert response.get_json()['count'] == 3
+    assert sheets['Data'].appends == 1
+    assert [row[7] for row in data_rows(sheets)] == ['Lầu 3', 'Lầu 3', 'Lầu 4']
+    assert sheets['LISTDS'].rows[2:] == [['SV1', 'Khoa Luật']]
+
+
+@pytest.mark.parametrize('room', ['x', ['3'], {'room': 3}])
+def test_bulk_rejects_invalid_room_per_item(client, sheets, room):
+    items = [CHECKIN, {**CHECKIN, 'phonghocnhom': room}, {'mssv': 'SV2'}]
+    response = client.post('/api/add_dulieusv_bulk', json={'items': items})
+
+    assert response.status_code == 400
+    assert [error['index'] for error in response.get_json()['errors']] == [1, 2]
+    assert data_rows(sheets) == []
+
+
+def test_bulk_rejects_too_many_items(client, sheets):
+    items = [CHECKIN] * (main.BULK_MAX_ITEMS + 1)
+    response = client.post('/api/add_dulieusv_bulk', json={'items': items})
+
+    assert response.status_code == 400
+    assert data_rows(sheets) == []